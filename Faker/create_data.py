@@ -1,18 +1,43 @@
 """
     Author: Jordan Wheeler
     Date: 2023-10-03
-    Description: This is a simple program that will create a csv file utilizing Faker.
-    
+    Description: This is a program that will create a csv file of synthetic
+    online transactions.
+
+    The original version built every row with random.choice and Faker,
+    held the whole list in memory and sorted it before writing. That does
+    not scale to the 100M-row files we use for load tests, so rows are now
+    generated with the NumPy random generator a chunk at a time:
+
+    - The time range is cut into equal windows and the number of rows in
+      each window is drawn up front with one multinomial draw. Each window
+      only has to sort its own timestamps, so the output comes out sorted
+      without ever holding more than one chunk in memory.
+    - Payment method, amount and category are drawn as whole arrays with
+      configurable weights and distributions.
+    - The same seed and --end always produce the same file. With --shards N the
+      time range is split into N contiguous pieces that are written in
+      parallel to N files; concatenating them in order gives one sorted
+      dataset.
+    - Timestamps have no time zone, like the original data: --end (default:
+      the local time now) is the last time written to the file, as given.
+      Internally times are seconds since 1970-01-01 in that same clock
+      (calendar.timegm), the convention NumPy's datetime64 uses to write
+      them back out, so the file does not shift by the machine's UTC offset.
+
+    Usage:
+        python Faker/create_data.py --rows 100000000 --shards 8 --seed 0
+
 """
 
-import random
-from faker import Faker
-import csv
-from datetime import datetime, timedelta
+import argparse
+import calendar
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-# Initialize Faker with a seed for reproducibility
-fake = Faker()
-Faker.seed(0)
+import numpy as np
 
 # Number of transactions to generate
 num_transactions = 1000
@@ -26,25 +51,246 @@ categories = ["Electronics", "Clothing", "Books", "Home & Garden", "Sports & Out
 # Output CSV file
 output_file = "online_transactions.csv"
 
-# Create a list to store the transactions
-transactions = []
+# Header row, matching data_online_transactions.csv
+header = "Payment_Method,Payment_Amount,Category,Timestamp\n"
+
+# Rows generated and written per chunk; memory use is bounded by this
+chunk_size = 1_000_000
+
+# Payment amount limits in dollars
+min_amount = 10.00
+max_amount = 500.00
+
+
+def parse_weights(text: str, names: list) -> np.ndarray:
+    """
+    Turn a comma separated list of weights into probabilities.
+
+    Parameters:
+        text (str): weights such as "3,3,1,1,1,1", or "" for a uniform mix
+        names (list): the values the weights apply to, in order
+    """
+    if not text:
+        return np.full(len(names), 1.0 / len(names))
+    weights = np.array([float(w) for w in text.split(",")])
+    if len(weights) != len(names) or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError(f"Expected {len(names)} non-negative weights for {names}, got {text!r}")
+    return weights / weights.sum()
+
+
+def zipf_weights(count: int, skew: float) -> np.ndarray:
+    """Zipf-like weights: the k-th value is chosen in proportion to 1 / k**skew."""
+    weights = 1.0 / np.arange(1, count + 1) ** skew
+    return weights / weights.sum()
+
+
+def draw_amounts(rng: np.random.Generator, size: int, distribution: str, sigma: float) -> np.ndarray:
+    """
+    Draw payment amounts in whole cents between min_amount and max_amount.
+
+    Parameters:
+        rng: the NumPy random generator to draw from
+        size (int): number of amounts to draw
+        distribution (str): "uniform" (as in the original script) or "lognormal"
+        sigma (float): spread of the lognormal distribution
+    """
+    low, high = round(min_amount * 100), round(max_amount * 100)
+    if distribution == "uniform":
+        return rng.integers(low, high, size=size, endpoint=True)
+    if distribution == "lognormal":
+        # Centre the distribution on the geometric mean of the limits
+        # and clip the long tail back into range
+        mean = np.log(np.sqrt(low * high))
+        cents = rng.lognormal(mean, sigma, size=size)
+        return np.clip(np.rint(cents), low, high).astype(np.int64)
+    raise ValueError(f"Unknown amount distribution: {distribution}")
+
+
+def wall_seconds(moment: datetime) -> int:
+    """
+    Seconds since 1970-01-01 of a time as written in the file, without a time zone.
+
+    A time with a UTC offset is converted to UTC first.
+    """
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return calendar.timegm(moment.timetuple())
+
+
+def text_table(names: list) -> np.ndarray:
+    """Encode strings as a byte matrix with one row per string, padded with NUL bytes."""
+    width = max(len(name) for name in names)
+    return np.array([name.encode() for name in names], dtype=f"S{width}").view(np.uint8).reshape(len(names), width)
+
+
+# Lookup tables so formatting is a gather instead of arithmetic per digit:
+# "HH:MM:SS" for every second of a day and "DDD.CC" for every amount in
+# cents, with no leading zeros on the dollars (NUL bytes are dropped later)
+time_of_day_table = text_table([f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in range(86400)])
+amount_table = text_table([f"{c // 100:>3d}.{c % 100:02d}".replace(" ", "\0") for c in range(round(max_amount * 100) + 1)])
+
+# Text of every row column in order; None marks where the table data goes
+row_layout = [None, b",", None, b",", None, b",", None, b" ", None, b"\n"]
+
+
+def format_rows(method_codes, cents, category_codes, seconds) -> bytes:
+    """
+    Render one chunk of generated columns as CSV bytes.
+
+    Formatting row by row with f-strings costs more than generating the
+    data, so every row is laid out in one byte matrix by gathering from
+    lookup tables: short values are padded with NUL bytes, which are then
+    dropped in a single pass.
+    """
+    # "YYYY-MM-DD" for every day the chunk touches
+    first_day = seconds[0] // 86400
+    day_index = seconds // 86400 - first_day
+    span = np.arange(first_day, first_day + day_index[-1] + 1).astype("datetime64[D]")
+    date_table = text_table(np.datetime_as_string(span).tolist())
+
+    columns = [
+        text_table(payment_methods)[method_codes],
+        amount_table[cents],
+        text_table(categories)[category_codes],
+        date_table[day_index],
+        time_of_day_table[seconds % 86400],
+    ]
+    data = iter(columns)
+    count = len(cents)
+    parts = [next(data) if text is None else np.tile(np.frombuffer(text, dtype=np.uint8), (count, 1))
+             for text in row_layout]
+    rows = np.hstack(parts)
+    return rows[rows != 0].tobytes()
+
+
+def write_shard(settings: dict, seed_sequence: np.random.SeedSequence, rows: int,
+                start_second: int, end_second: int, path: str, include_header: bool) -> int:
+    """
+    Generate one contiguous time range of transactions and write it to path.
+
+    Parameters:
+        settings (dict): distribution settings shared by every shard
+        seed_sequence: independent seed for this shard
+        rows (int): number of rows in this shard
+        start_second, end_second (int): time range covered by the shard (see wall_seconds)
+        path (str): output file
+        include_header (bool): whether to write the header row first
+    """
+    rng = np.random.default_rng(seed_sequence)
+    method_p = settings["method_p"]
+    category_p = settings["category_p"]
+
+    # Cut the range into windows of about chunk_size rows and decide
+    # up front how many rows fall in each window
+    windows = max(1, -(-rows // chunk_size))
+    edges = np.linspace(start_second, end_second, windows + 1)
+    counts = rng.multinomial(rows, np.full(windows, 1.0 / windows))
+
+    with open(path, mode="wb") as file:
+        if include_header:
+            file.write(header.encode())
+        for window, count in enumerate(counts.tolist()):
+            if count == 0:
+                continue
+            # Sorting one window at a time keeps the whole file in order
+            seconds = np.sort(rng.uniform(edges[window], edges[window + 1], size=count)).astype(np.int64)
+            method_codes = rng.choice(len(payment_methods), size=count, p=method_p)
+            cents = draw_amounts(rng, count, settings["amount_distribution"], settings["amount_sigma"])
+            category_codes = rng.choice(len(categories), size=count, p=category_p)
+            file.write(format_rows(method_codes, cents, category_codes, seconds))
+    return rows
+
+
+def generate(rows: int, path: str, seed: int = 0, shards: int = 1, days: int = 365,
+             end: datetime = None, method_weights: str = "", category_weights: str = "",
+             category_skew: float = 0.0, amount_distribution: str = "uniform",
+             amount_sigma: float = 0.6) -> list:
+    """
+    Generate rows transactions covering the last days days and write them to path.
+
+    With shards > 1 the output is split into path-00000.csv, path-00001.csv, ...
+    written in parallel, each holding a contiguous, sorted slice of time.
+    Returns the list of files written.
+    """
+    end = end or datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=days)
+    settings = {
+        "method_p": parse_weights(method_weights, payment_methods),
+        "category_p": (zipf_weights(len(categories), category_skew) if category_skew
+                       else parse_weights(category_weights, categories)),
+        "amount_distribution": amount_distribution,
+        "amount_sigma": amount_sigma,
+    }
+
+    # One independent stream for the shard sizes and one per shard,
+    # all derived from the same seed
+    splitter, *shard_seeds = np.random.SeedSequence(seed).spawn(shards + 1)
+    per_shard = np.random.default_rng(splitter).multinomial(rows, np.full(shards, 1.0 / shards))
+    edges = np.linspace(wall_seconds(start), wall_seconds(end), shards + 1)
+
+    if shards == 1:
+        write_shard(settings, shard_seeds[0], rows, edges[0], edges[1], path, True)
+        return [path]
 
-# Generate transactions
-for _ in range(num_transactions):
-    payment_method = random.choice(payment_methods)
-    payment_amount = round(random.uniform(10, 500), 2)  # Random payment amount between $10 and $500
-    category = random.choice(categories)
-    timestamp = fake.date_time_between(start_date="-1y", end_date="now")  # Transactions from the past year
+    stem, ext = os.path.splitext(path)
+    paths = [f"{stem}-{i:05d}{ext or '.csv'}" for i in range(shards)]
+    with ProcessPoolExecutor(max_workers=min(shards, os.cpu_count() or 1)) as pool:
+        jobs = [
+            pool.submit(write_shard, settings, seq, int(n), edges[i], edges[i + 1], paths[i], i == 0)
+            for i, (seq, n) in enumerate(zip(shard_seeds, per_shard))
+        ]
+        for job in jobs:
+            job.result()
+    return paths
 
-    transactions.append([payment_method, payment_amount, category, timestamp])
 
-# Sort transactions by timestamp
-transactions.sort(key=lambda x: x[3])
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate synthetic online transactions.")
+    parser.add_argument("--rows", type=int, default=num_transactions, help="number of transactions")
+    parser.add_argument("--output", default=output_file, help="output csv file")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for reproducibility")
+    parser.add_argument("--shards", type=int, default=1, help="number of files to write in parallel")
+    parser.add_argument("--days", type=int, default=365, help="length of the time range")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=None,
+                        help="end of the time range as written in the file, e.g. 2023-10-03 "
+                             "(default: the local time now)")
+    parser.add_argument("--method-weights", default="", help=f"weights for {payment_methods}")
+    parser.add_argument("--category-weights", default="", help=f"weights for {categories}")
+    parser.add_argument("--category-skew", type=float, default=0.0,
+                        help="Zipf exponent for categories; overrides --category-weights")
+    parser.add_argument("--amount-distribution", choices=["uniform", "lognormal"], default="uniform")
+    parser.add_argument("--amount-sigma", type=float, default=0.6, help="spread of lognormal amounts")
+    args = parser.parse_args()
+    # Report bad values as a usage error rather than a traceback
+    if args.rows < 0:
+        parser.error("--rows must not be negative")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    for option, text, names in [("--method-weights", args.method_weights, payment_methods),
+                                ("--category-weights", args.category_weights, categories)]:
+        try:
+            parse_weights(text, names)
+        except ValueError as e:
+            parser.error(f"{option}: {e}")
+    return args
 
-# Write the data to a CSV file
-with open(output_file, mode="w", newline="") as file:
-    writer = csv.writer(file)
-    writer.writerow(["Payment Method", "Payment Amount", "Category", "Timestamp"])
-    writer.writerows(transactions)
 
-print(f"Generated {num_transactions} online transactions and saved to {output_file}.")
+if __name__ == "__main__":
+    args = parse_args()
+    started = time.perf_counter()
+    files = generate(
+        rows=args.rows,
+        path=args.output,
+        seed=args.seed,
+        shards=args.shards,
+        days=args.days,
+        end=args.end,
+        method_weights=args.method_weights,
+        category_weights=args.category_weights,
+        category_skew=args.category_skew,
+        amount_distribution=args.amount_distribution,
+        amount_sigma=args.amount_sigma,
+    )
+    elapsed = time.perf_counter() - started
+    print(f"Generated {args.rows} online transactions in {elapsed:.2f}s "
+          f"({args.rows / max(elapsed, 1e-9):,.0f} rows/s) and saved to {', '.join(files)}.")
@@ -0,0 +1,224 @@
+"""
+    Business rules for the amount consumer, read from rules.toml.
+
+    The Store Card discount and the alert threshold used to be hard-coded
+    in consumer_02_amount.py. They now live in a rules file with two
+    kinds of rules:
+
+    - [[discounts]]: percent off for a payment_method and/or category.
+      A rule without payment_method or category matches any. The first
+      matching discount in the file wins.
+    - [[alerts]]: when the amount after the discount is at least
+      min_amount, send it to route ("email" or "log") with an optional
+      subject. Every matching alert fires.
+
+    Rules are compiled, not interpreted per message. Compiling indexes the
+    rules by the payment method and category they name. The first message
+    for a payment method and category (any not named in the rules share
+    one "anything else" slot) gets a decision built from that index: the
+    discount multiplier and the alerts sorted by threshold. After that,
+    evaluating a message is two set lookups, one dict lookup and a bisect,
+    no matter how many rules there are.
+
+    RulesFile checks the file's modification time at most once per
+    check_every seconds from the consumer's own thread. When it changes,
+    the new rules are compiled and swapped in with a single assignment,
+    so a message sees either the old rules or the new ones, never a mix.
+    If the new file is broken the old rules stay in place and the error
+    is logged.
+
+    See benchmarks/bench_rules.py for the cost as the rule count grows.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import bisect
+import os
+import time
+import tomllib  # requires Python 3.11
+from typing import NamedTuple
+
+# Alert routes the consumer knows how to deliver
+ROUTES = ("email", "log")
+
+# Used when there is no rules file: the original hard-coded rules
+DEFAULT_RULES = {
+    "discounts": [{"payment_method": "Store Card", "percent": 10}],
+    "alerts": [{"payment_method": "Store Card", "min_amount": 425.00, "route": "email",
+                "subject": "Store Card Used"}],
+}
+
+# Stands for any payment method or category not named in the rules
+OTHER = object()
+
+
+class Alert(NamedTuple):
+    min_amount: float
+    route: str
+    subject: str
+
+
+class Decision(NamedTuple):
+    """What to do with one payment method and category."""
+    discount_percent: float
+    multiplier: float
+    thresholds: tuple  # min_amount of each alert, ascending
+    alerts: tuple      # the Alert for each threshold
+
+
+class Outcome(NamedTuple):
+    """The result of evaluating one payment."""
+    amount: float
+    discount_percent: float
+    alerts: tuple
+
+
+def _matches(rule: dict, payment_method, category) -> bool:
+    return (rule.get("payment_method", payment_method) == payment_method
+            and rule.get("category", category) == category)
+
+
+def _validate(rules: dict):
+    """Raise ValueError for a rules file that cannot be compiled."""
+    for rule in rules.get("discounts", []):
+        if not 0 <= rule.get("percent", -1) <= 100:
+            raise ValueError(f"discount percent must be between 0 and 100: {rule}")
+    for rule in rules.get("alerts", []):
+        if rule.get("route") not in ROUTES:
+            raise ValueError(f"alert route must be one of {ROUTES}: {rule}")
+        if "min_amount" not in rule:
+            raise ValueError(f"alert needs a min_amount: {rule}")
+    for rule in rules.get("discounts", []) + rules.get("alerts", []):
+        unknown = set(rule) - {"payment_method", "category", "percent", "min_amount", "route", "subject"}
+        if unknown:
+            raise ValueError(f"unknown rule keys {sorted(unknown)}: {rule}")
+
+
+class CompiledRules:
+    """
+    Rules compiled into a lookup table of decisions.
+
+    Parameters:
+        rules (dict): {"discounts": [...], "alerts": [...]} as in rules.toml
+    """
+
+    def __init__(self, rules: dict):
+        _validate(rules)
+        discounts = rules.get("discounts", [])
+        alerts = rules.get("alerts", [])
+        self.rule_count = len(discounts) + len(alerts)
+
+        every_rule = discounts + alerts
+        self.methods = frozenset(r["payment_method"] for r in every_rule if "payment_method" in r)
+        self.categories = frozenset(r["category"] for r in every_rule if "category" in r)
+
+        # Index the rules by the fields they name, so a decision only
+        # looks at the rules that could match it:
+        # (payment_method or OTHER, category or OTHER) -> rules in file order
+        self.discounts = {}
+        for index, rule in enumerate(discounts):
+            self.discounts.setdefault(self._key(rule), []).append((index, rule["percent"]))
+        self.alerts = {}
+        for rule in alerts:
+            alert = Alert(float(rule["min_amount"]), rule["route"], rule.get("subject", "Purchase Alert"))
+            self.alerts.setdefault(self._key(rule), []).append(alert)
+
+        # Decisions are made the first time a payment method and category
+        # are seen and then reused, so compiling costs the same however
+        # many methods and categories the rules name
+        self.table = {}
+
+    @staticmethod
+    def _key(rule: dict) -> tuple:
+        return rule.get("payment_method", OTHER), rule.get("category", OTHER)
+
+    def _decide(self, payment_method, category) -> Decision:
+        # OTHER matches only the rules that leave the field out;
+        # dict.fromkeys drops the repeats when a field is already OTHER
+        keys = dict.fromkeys([(payment_method, category), (payment_method, OTHER),
+                              (OTHER, category), (OTHER, OTHER)])
+        # the first matching discount in the file has the lowest index
+        _, percent = min((self.discounts[key][0] for key in keys if key in self.discounts), default=(None, 0))
+        matching = sorted(alert for key in keys for alert in self.alerts.get(key, ()))
+        return Decision(percent, 1 - percent / 100, tuple(a.min_amount for a in matching), tuple(matching))
+
+    def decision(self, payment_method: str, category: str = None) -> Decision:
+        """The decision for a payment method and category."""
+        if payment_method not in self.methods:
+            payment_method = OTHER
+        if category not in self.categories:
+            category = OTHER
+        try:
+            return self.table[payment_method, category]
+        except KeyError:
+            decision = self.table[payment_method, category] = self._decide(payment_method, category)
+            return decision
+
+    def evaluate(self, payment_method: str, category: str, amount: float) -> Outcome:
+        """Apply the discount and find the alerts for one payment."""
+        decision = self.decision(payment_method, category)
+        new_amount = amount * decision.multiplier
+        # thresholds are sorted, so the alerts that fire are a prefix
+        fired = decision.alerts[:bisect.bisect_right(decision.thresholds, new_amount)]
+        return Outcome(new_amount, decision.discount_percent, fired)
+
+
+def load_rules(path: str = "rules.toml") -> CompiledRules:
+    """Read and compile a rules file, or the built-in rules if there is none."""
+    try:
+        with open(path, "rb") as file_object:
+            return CompiledRules(tomllib.load(file_object))
+    except FileNotFoundError:
+        return CompiledRules(DEFAULT_RULES)
+
+
+class RulesFile:
+    """
+    A rules file that is recompiled when it changes.
+
+    Parameters:
+        path (str): the rules file
+        check_every (float): the most often, in seconds, to look at the file
+        logger: where to log reloads and broken rules files
+    """
+
+    def __init__(self, path: str = "rules.toml", check_every: float = 1.0, logger=None, clock=time.monotonic):
+        self.path = path
+        self.check_every = check_every
+        self.logger = logger
+        self.clock = clock
+        self.signature = self._signature()
+        self.rules = load_rules(path)
+        self.checked_at = clock()
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def current(self) -> CompiledRules:
+        """The rules in force, reloading them first if the file changed."""
+        now = self.clock()
+        if now - self.checked_at >= self.check_every:
+            self.checked_at = now
+            signature = self._signature()
+            if signature != self.signature:
+                self.signature = signature
+                self.reload()
+        return self.rules
+
+    def reload(self):
+        """Compile the file again; keep the old rules if it is broken."""
+        try:
+            rules = load_rules(self.path)
+        except (ValueError, TypeError, KeyError, tomllib.TOMLDecodeError) as e:
+            if self.logger:
+                self.logger.error(f" [rules] Keeping the old rules, {self.path} is invalid: {e}")
+            return
+        # a single assignment, so the swap is atomic for the callback
+        self.rules = rules
+        if self.logger:
+            self.logger.info(f" [rules] Reloaded {rules.rule_count} rules from {self.path}")
@@ -0,0 +1,264 @@
+"""
+    Backpressure for the producer: watch queue depth and slow down or
+    pause publishing to queues whose consumers are not keeping up.
+
+    The producer used to publish blindly. When a consumer falls behind
+    (02-amount blocks on SMTP for every alert) its queue grows until the
+    broker hits a memory alarm. Here every queue is sampled at most once
+    per poll interval, and the drain rate is estimated from how much the
+    depth moved against how much we published:
+
+    - depth below the low watermark: publish freely
+    - between the watermarks: publish no faster than the queue drains,
+      and at least one poll interval apart while it drains nothing (so a
+      stuck consumer is noticed at the next sample, not at the high mark)
+    - at the high watermark: pause the queue until it drains back down
+      to the low watermark
+
+    The observed lag (seconds of work waiting in the queue at the current
+    drain rate) is kept per queue and logged regularly.
+
+    Probes supply (depth, consumer count) for a queue:
+
+    - PassiveDeclareProbe: queue_declare(passive=True) on a pika channel
+    - ManagementApiProbe: the RabbitMQ management HTTP API
+    - StaticProbe: fixed values set by hand, a stand-in for tests
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import base64
+import json
+import time
+import urllib.parse
+
+
+class PassiveDeclareProbe:
+    """Read queue depth and consumer count with a passive queue_declare."""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def sample(self, queue: str):
+        result = self.channel.queue_declare(queue=queue, passive=True)
+        return result.method.message_count, result.method.consumer_count
+
+
+class ManagementApiProbe:
+    """
+    Read queue depth and consumer count from the RabbitMQ management API.
+
+    A request that fails raises OSError (urllib's URLError and HTTPError
+    included); Backpressure treats that as no new sample.
+    """
+
+    def __init__(self, url: str = "http://localhost:15672", vhost: str = "/",
+                 user: str = "guest", password: str = "guest", timeout: float = 2.0):
+        self.url = url.rstrip("/")
+        self.vhost = urllib.parse.quote(vhost, safe="")
+        self.auth = "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.timeout = timeout
+
+    def sample(self, queue: str):
+        # urllib.request (and the http and ssl modules behind it) is
+        # only loaded when the management API is used
+        import urllib.request
+
+        request = urllib.request.Request(
+            f"{self.url}/api/queues/{self.vhost}/{urllib.parse.quote(queue, safe='')}",
+            headers={"Authorization": self.auth},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            info = json.load(response)
+        # "messages" counts ready and unacknowledged messages
+        return info.get("messages", 0), info.get("consumers", 0)
+
+
+class StaticProbe:
+    """Report depths and consumer counts set by hand, for tests and dry runs."""
+
+    def __init__(self, depths: dict = None, consumers: dict = None):
+        self.depths = dict(depths or {})
+        self.consumers = dict(consumers or {})
+
+    def sample(self, queue: str):
+        return self.depths.get(queue, 0), self.consumers.get(queue, 1)
+
+
+class QueueState:
+    """What we last observed about one queue."""
+
+    def __init__(self):
+        self.depth = 0
+        self.consumers = 0
+        self.drain_rate = 0.0
+        self.lag = 0.0
+        self.paused = False
+        self.sampled_at = None
+        self.failed_at = None
+        self.published_since_sample = 0
+        self.next_publish_at = 0.0
+
+    def as_dict(self):
+        return {
+            "depth": self.depth,
+            "consumers": self.consumers,
+            "drain_rate": self.drain_rate,
+            "lag": self.lag,
+            "paused": self.paused,
+        }
+
+
+class Backpressure:
+    """
+    Decide per queue whether the producer may publish now.
+
+    Parameters:
+        probe: object with sample(queue) -> (depth, consumers)
+        queues (list): names of the queues to watch
+        high_watermark (int): depth at which a queue is paused
+        low_watermark (int): depth at which a paused queue resumes and
+            above which publishing is throttled (default: half the high mark)
+        poll_interval (float): minimum seconds between samples of a queue
+        pause_without_consumers (bool): also pause a queue nobody consumes
+        smoothing (float): weight of the newest drain rate estimate (0-1)
+        logger: where to log pauses, resumes and status lines
+        report_every (float): seconds between status lines
+    """
+
+    def __init__(self, probe, queues, high_watermark: int = 10000, low_watermark: int = None,
+                 poll_interval: float = 1.0, pause_without_consumers: bool = False,
+                 smoothing: float = 0.3, logger=None, report_every: float = 10.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.probe = probe
+        self.high_watermark = high_watermark
+        self.low_watermark = high_watermark // 2 if low_watermark is None else low_watermark
+        if self.low_watermark > self.high_watermark:
+            raise ValueError("low_watermark must not be above high_watermark")
+        self.poll_interval = poll_interval
+        self.pause_without_consumers = pause_without_consumers
+        self.smoothing = smoothing
+        self.logger = logger
+        self.report_every = report_every
+        self.clock = clock
+        self.sleep = sleep
+        self.queues = {queue: QueueState() for queue in queues}
+        self.last_report = clock()
+
+    def refresh(self, queue: str, force: bool = False) -> QueueState:
+        """Sample the queue if the poll interval has passed (or force is set), and update its state."""
+        state = self.queues[queue]
+        now = self.clock()
+        if not force and state.sampled_at is not None and now - state.sampled_at < self.poll_interval:
+            return state
+        if state.failed_at is not None and now - state.failed_at < self.poll_interval:
+            # The probe failed recently; do not hold up every publish trying again
+            return state
+
+        try:
+            depth, consumers = self.probe.sample(queue)
+        except (OSError, ValueError) as e:
+            # The management API is down, refused us or sent something
+            # unreadable: no new sample, go on with what we knew
+            if self.logger and state.failed_at is None:
+                self.logger.warning(f" [backpressure] Could not read the depth of {queue}, "
+                                    f"keeping the last sample: {e}")
+            state.failed_at = now
+            return state
+        if self.logger and state.failed_at is not None:
+            self.logger.info(f" [backpressure] Reading the depth of {queue} again")
+        state.failed_at = None
+        if state.sampled_at is not None and now > state.sampled_at:
+            # Whatever we published that is not in the queue any more was consumed
+            drained = state.depth + state.published_since_sample - depth
+            rate = max(drained, 0) / (now - state.sampled_at)
+            state.drain_rate += self.smoothing * (rate - state.drain_rate)
+        state.depth, state.consumers = depth, consumers
+        state.sampled_at, state.published_since_sample = now, 0
+        if depth == 0:
+            state.lag = 0.0
+        else:
+            state.lag = depth / state.drain_rate if state.drain_rate > 0 else float("inf")
+
+        was_paused = state.paused
+        if depth >= self.high_watermark or (self.pause_without_consumers and consumers == 0):
+            state.paused = True
+        elif depth <= self.low_watermark and (consumers > 0 or not self.pause_without_consumers):
+            state.paused = False
+        if self.logger and state.paused != was_paused:
+            action = "Pausing" if state.paused else "Resuming"
+            self.logger.warning(f" [backpressure] {action} {queue}: depth {depth}, consumers {consumers}, "
+                                f"lag {state.lag:.1f}s")
+
+        if self.logger and now - self.last_report >= self.report_every:
+            self.last_report = now
+            self.report()
+        return state
+
+    def ready(self, queue: str) -> bool:
+        """Return True if a message may be published to the queue right now."""
+        state = self.refresh(queue)
+        if not state.paused and state.depth + state.published_since_sample >= self.high_watermark:
+            # Everything we published since the last sample may still be
+            # queued, so look again rather than overrun the high watermark
+            state = self.refresh(queue, force=True)
+        if state.paused:
+            return False
+        return self.clock() >= state.next_publish_at
+
+    def published(self, queue: str, count: int = 1):
+        """Record that count messages were published to the queue."""
+        state = self.queues[queue]
+        state.published_since_sample += count
+        if state.depth + state.published_since_sample > self.low_watermark:
+            # Throttle to the drain rate so the queue stops growing. A queue
+            # that drains nothing (no consumer, or one stuck on SMTP) still
+            # gets one message per poll interval, to see if it starts again
+            gap = count * self.poll_interval
+            if state.drain_rate > 0:
+                gap = min(gap, count / state.drain_rate)
+            state.next_publish_at = self.clock() + gap
+        else:
+            state.next_publish_at = 0.0
+
+    def rejected(self, queue: str):
+        """
+        Record that the broker refused a message for the queue (e.g. it is
+        full and its overflow policy is reject-publish). The queue is paused
+        until a new sample shows it below the low watermark.
+        """
+        state = self.queues[queue]
+        if self.logger and not state.paused:
+            self.logger.warning(f" [backpressure] Pausing {queue}: the broker refused a message, "
+                                f"the queue is full")
+        state.paused = True
+        # count the refused message as a sample, so the next one is due a poll interval from now
+        state.sampled_at = self.clock()
+        state.published_since_sample = 0
+
+    def wait(self, queue: str):
+        """Block until a message may be published to the queue."""
+        while not self.ready(queue):
+            state = self.queues[queue]
+            if state.paused:
+                self.sleep(self.poll_interval)
+            else:
+                self.sleep(max(state.next_publish_at - self.clock(), 0.0))
+
+    def lag(self, queue: str) -> float:
+        """Seconds of work waiting in the queue at its observed drain rate."""
+        return self.queues[queue].lag
+
+    def snapshot(self) -> dict:
+        """The last observed state of every queue."""
+        return {queue: state.as_dict() for queue, state in self.queues.items()}
+
+    def report(self):
+        """Log one status line per queue."""
+        for queue, state in self.queues.items():
+            self.logger.info(
+                f" [backpressure] {queue}: depth {state.depth}, consumers {state.consumers}, "
+                f"drain {state.drain_rate:.1f} msg/s, lag {state.lag:.1f}s"
+                + (", paused" if state.paused else "")
+            )
@@ -0,0 +1,96 @@
+"""
+    Benchmark: cost of evaluating the amount rules per message as the
+    number of rules grows.
+
+    Builds rule sets of increasing size over made-up payment methods and
+    categories, compiles them, and times evaluate() on a stream of
+    payments. The first pass also builds a decision for each payment
+    method and category pair it meets ("decisions"); later passes only
+    look them up. For comparison it also times interpreting the same rules
+    per message (scanning the rule lists, as a straightforward engine
+    would), whose cost grows with the rule count.
+
+    Usage:
+        python benchmarks/bench_rules.py
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import pathlib
+import random
+import sys
+import time
+
+# Make the project modules importable when run from anywhere
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from amount_rules import CompiledRules, _matches  # noqa: E402
+
+RULE_COUNTS = [1, 10, 100, 1000]
+MESSAGES = 100_000
+
+
+def make_rules(count: int, rng: random.Random) -> dict:
+    """Half discounts, half alerts, over about count / 4 methods and categories each."""
+    methods = [f"Method {i}" for i in range(max(1, count // 4))]
+    categories = [f"Category {i}" for i in range(max(1, count // 4))]
+    discounts, alerts = [], []
+    for i in range(count):
+        rule = {}
+        if rng.random() < 0.8:
+            rule["payment_method"] = rng.choice(methods)
+        if rng.random() < 0.5:
+            rule["category"] = rng.choice(categories)
+        if i % 2:
+            discounts.append({**rule, "percent": rng.randint(1, 30)})
+        else:
+            alerts.append({**rule, "min_amount": rng.uniform(100, 500), "route": "log"})
+    return {"discounts": discounts, "alerts": alerts}, methods, categories
+
+
+def interpret(rules: dict, payment_method: str, category: str, amount: float):
+    """Evaluate the rules by scanning them, without compiling."""
+    percent = next((r["percent"] for r in rules["discounts"] if _matches(r, payment_method, category)), 0)
+    amount = amount * (1 - percent / 100)
+    return amount, [r for r in rules["alerts"] if _matches(r, payment_method, category) and amount >= r["min_amount"]]
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'rules':>6} {'compile ms':>11} {'decisions':>10} {'first pass ns/msg':>18} "
+          f"{'compiled ns/msg':>16} {'interpreted ns/msg':>19}")
+    for count in RULE_COUNTS:
+        rules, methods, categories = make_rules(count, rng)
+        # some traffic hits methods and categories no rule names
+        payments = [(rng.choice(methods + ["Store Card"]), rng.choice(categories + ["Books"]), rng.uniform(10, 500))
+                    for _ in range(MESSAGES)]
+
+        started = time.perf_counter()
+        compiled = CompiledRules(rules)
+        compile_ms = (time.perf_counter() - started) * 1000
+
+        evaluate = compiled.evaluate
+        started = time.perf_counter()
+        for payment_method, category, amount in payments:
+            evaluate(payment_method, category, amount)
+        first_pass_ns = (time.perf_counter() - started) / MESSAGES * 1e9
+
+        # Every decision is built now: the cost from here on
+        started = time.perf_counter()
+        for payment_method, category, amount in payments:
+            evaluate(payment_method, category, amount)
+        compiled_ns = (time.perf_counter() - started) / MESSAGES * 1e9
+
+        sample = payments[: max(1000, MESSAGES // count)]
+        started = time.perf_counter()
+        for payment_method, category, amount in sample:
+            interpret(rules, payment_method, category, amount)
+        interpreted_ns = (time.perf_counter() - started) / len(sample) * 1e9
+
+        print(f"{count:>6} {compile_ms:>11.1f} {len(compiled.table):>10} {first_pass_ns:>18.0f} "
+              f"{compiled_ns:>16.0f} {interpreted_ns:>19.0f}")
+
+
+if __name__ == "__main__":
+    main()
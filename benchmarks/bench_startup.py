@@ -0,0 +1,116 @@
+"""
+    Benchmark: how long the producer and consumers take to start.
+
+    Each program is started in a fresh Python process several times and
+    timed up to the point where it would connect to RabbitMQ: importing
+    the program module and then pika (which each main() imports first).
+    The times for an empty Python process and for one that only imports
+    pika are shown alongside: pika 1.x always imports asyncio and ssl,
+    so no program can start faster than that. "over pika" is the rest,
+    the part this project controls.
+
+    The budget applies to "over pika" only, so the check means the same on
+    a fast or a slow machine and with any pika version; the absolute times
+    are shown for information. The process exits with status 1 if any
+    program's median start is more than the budget over pika's, so this
+    can run as a check:
+
+        python benchmarks/bench_startup.py
+        python benchmarks/bench_startup.py --budget-ms 20 --runs 20
+        python benchmarks/bench_startup.py --importtime    also list what each program imports
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import argparse
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# Program modules started by the console scripts in pyproject.toml
+PROGRAMS = [
+    "message_producer",
+    "consumer_01_method",
+    "consumer_02_amount",
+    "consumer_03_category",
+    "consumer_04_store",
+    "dlq_replay",
+    "transaction_store",
+]
+
+
+def time_processes(codes: list, runs: int) -> list:
+    """
+    Median wall time, in ms, of running each piece of code in a new Python process.
+
+    The pieces take turns, round by round, so a machine that slows down or
+    speeds up during the benchmark affects them all alike.
+    """
+    times = [[] for _ in codes]
+    for _ in range(runs):
+        for code, samples in zip(codes, times):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True)
+            samples.append((time.perf_counter() - started) * 1000)
+    return [statistics.median(samples) for samples in times]
+
+
+def slowest_imports(module: str, count: int = 5) -> list:
+    """What module imports directly, slowest first, from python -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # importtime indents each level by two spaces; keep the first level
+        # below the program module
+        if name.startswith("   ") and not name.startswith("    "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time the start of the producer and consumers.")
+    parser.add_argument("--runs", type=int, default=10, help="processes started per program")
+    parser.add_argument("--budget-ms", type=float, default=30.0,
+                        help="the most a program may add on top of importing pika")
+    parser.add_argument("--importtime", action="store_true",
+                        help="list the slowest modules each program imports directly")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    codes = ["pass", "import pika"]
+    for module in PROGRAMS:
+        codes += [f"import {module}", f"import {module}, pika"]
+    floor, pika, *programs = time_processes(codes, args.runs)
+    print(f"empty Python process: {floor:.1f} ms, import pika: {pika:.1f} ms, "
+          f"budget: {args.budget_ms:g} ms over pika")
+    print(f"{'program':<22} {'import ms':>10} {'ready ms':>9} {'over pika ms':>13}")
+
+    over_budget = []
+    for module, imported, ready in zip(PROGRAMS, programs[::2], programs[1::2]):
+        over = ready - pika > args.budget_ms
+        print(f"{module:<22} {imported:>10.1f} {ready:>9.1f} {ready - pika:>13.1f}"
+              f"{'  OVER BUDGET' if over else ''}")
+        if over:
+            over_budget.append(module)
+        if args.importtime:
+            for cumulative, name in slowest_imports(module):
+                print(f"    {cumulative:>8.1f} ms  {name}")
+
+    if over_budget:
+        print(f"More than {args.budget_ms:g} ms over pika: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,17 @@
       
 """
 
-import pika
 import sys
 
+from dedup import Deduplicator
+from message_handling import PoisonMessage, reliable_callback
+from queue_topology import declare_queue, load_topology
+
 # Configure logging
-from util_logger import setup_logger
+# The handlers are added in main(), so importing this module is cheap
+from util_logger import get_logger, setup_logger
 
-logger, logname = setup_logger(__file__)
+logger = get_logger(__file__)
 
 # Global Variable for Category Counts
 payment_method_counts = {}
@@ -23,6 +27,7 @@ def method_callback(ch, method, properties, body):
     """ Define behavior on getting a message.
         This function will be called each time a message is received.
         The function must accept the four arguments shown here.
+        reliable_callback acks the message once this returns.
     """
     # Decode the binary message body to a string
     logger.info(f" [x] Received {body.decode()}")
@@ -32,6 +37,9 @@ def method_callback(ch, method, properties, body):
     payment_method = body.decode()
     
     payment_method_split = payment_method.split(",")
+    # Check if the message has the expected format (timestamp,method)
+    if len(payment_method_split) != 2:
+        raise PoisonMessage(f"Expected timestamp,method but got {payment_method!r}")
     payment_method = payment_method_split[1]
     
     # Increment the count for the payment method
@@ -51,12 +59,16 @@ def method_callback(ch, method, properties, body):
 
     # Send Confirmation Report
     logger.info(f"[X] {payment_method} Received and Processed.")
-    # Delete Message from Queue after Processing
-    ch.basic_ack(delivery_tag=method.delivery_tag)
 
 # Define a main function to run the program
-def main(hn: str = "localhost", qn: str = "task_queue"):
+def main(hn: str = "localhost", qn: str = "01-method", banner: bool = True):
     """ Continuously listen for task messages on a named queue."""
+    setup_logger(__file__, banner=banner)
+
+    # pika takes most of the startup time; import it only when connecting
+    import pika
+
+    deduplicator = None
 
     # When a statement can go wrong, use a try-except block
     try:
@@ -81,7 +93,13 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         # A durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # Messages will not be deleted until the consumer acknowledges
-        channel.queue_declare(queue=qn, durable=True)
+        # The settings come from queues.toml so they match the producer's
+        topology = load_topology()
+        declare_queue(channel, qn, **topology)
+
+        # Remember processed message ids so a redelivered message
+        # is not counted twice
+        deduplicator = Deduplicator(**topology["dedup"], path=f"{qn}.seen", logger=logger)
 
         # The QoS level controls the number of messages
         # that can be in-flight (unacknowledged by the consumer)
@@ -96,7 +114,12 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         # Configure the channel to listen on a specific queue,
         # use the callback function named callback,
         # and do not auto-acknowledge the message (let the callback handle it)
-        channel.basic_consume(queue=qn, on_message_callback=method_callback, auto_ack=False)
+        # reliable_callback acks, retries or dead-letters every message
+        # so one bad message cannot stall the queue
+        on_message = reliable_callback(method_callback, logger, qn, topology["dead_letter_exchange"],
+                                       topology["max_retries"], topology["retry_delay"],
+                                       deduplicator=deduplicator)
+        channel.basic_consume(queue=qn, on_message_callback=on_message, auto_ack=False)
 
         # Print a message to the console for the user
         logger.info(" [*] Ready for work. To exit, press CTRL+C")
@@ -116,6 +139,8 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         sys.exit(0)
     finally:
         logger.info("\nClosing connection. Goodbye.\n")
+        if deduplicator is not None:
+            deduplicator.save()
         connection.close()
 
 # Standard Python idiom to indicate the main program entry point
@@ -9,16 +9,22 @@
 
 
 
-import pika
 import sys
 
-# Import function for sending email
-from email_alert import createAndSendEmailAlert
+from amount_rules import RulesFile
+from dedup import Deduplicator
+from message_handling import PoisonMessage, reliable_callback
+from queue_topology import declare_queue, load_topology
 
 # Configure logging
-from util_logger import setup_logger
+# The handlers are added in main(), so importing this module is cheap
+from util_logger import get_logger, setup_logger
 
-logger, logname = setup_logger(__file__)
+logger = get_logger(__file__)
+
+# Global Variable for the discounts and alert thresholds,
+# loaded in main() and reloaded when rules.toml changes
+rules = None
 
 # Initialize the original price as None
 original_price = None
@@ -28,6 +34,8 @@ def amount_callback(ch, method, properties, body):
     """ Define behavior on getting a message.
         This function will be called each time a message is received.
         The function must accept the four arguments shown here.
+        reliable_callback acks the message once this returns, and retries
+        or dead-letters it if this raises.
     """
     global original_price  # Declare original_price as a global variable
 
@@ -35,48 +43,55 @@ def amount_callback(ch, method, properties, body):
     message = body.decode()
     # Split Message
     message = message.split(",")
+    # Check if the message has the expected format (timestamp,amount,method[,category])
+    if len(message) not in (3, 4) or message[2] == '':
+        raise PoisonMessage(f"Expected timestamp,amount,method,category but got {body.decode()!r}")
     message1 = message[0]
     message2 = message[1]
-    formatted_message2 = "${:.2f}".format(float(message2))
+    # Check for a valid amount
+    try:
+        payment_amount_change = round(float(message2), 2)
+    except ValueError:
+        raise PoisonMessage(f"Invalid payment amount: {message2!r}")
+    formatted_message2 = "${:.2f}".format(payment_amount_change)
     logger.info(f" [x] At {message1} a purchase has been made in the amount of {formatted_message2}")
-    
-    payment_amount_change = []
-    try: 
-            # Check for valid temperatures
-        if message[1] != None and message[2] != '':
-            # Convert to float
-            payment_amount_change = round(float(message2), 2)
-            # Check for valid timestamp
-            payment_timestamp = message1
-            
-             
-        # Check if payment method is store card and apply 10% discount
-        payment_method = message[2]
-        if payment_method == "Store Card":
-            payment_amount_change = payment_amount_change * 0.9
-            new_payment = payment_amount_change
-            formatted_new_payment = "${:.02f}".format(new_payment)
-            alert_message = True
-        
-        # Check if alert is true and payment is greater than $425.00
-            if alert_message == True and new_payment >= 425.00:
-                logger.warning(f"A Store Card has been used. The new price is {formatted_new_payment}.")
-                # Create Email Parts
-                email_subject = "Store Card Used"
-                email_body = f"A Store Card has been used at {payment_timestamp}. The original price was {formatted_message2}. The new price is {formatted_new_payment}."
-                createAndSendEmailAlert(email_subject, email_body)
-                logger.info("Email Sent")
-            
-            logger.info(f"[X] Store Card Was Used. New price is {formatted_new_payment}.")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    
-    except Exception as e:
-        logger.error("An Error Occurred While Processing Payment Amounts.")
-        logger.error(f"The error says: {e}")
+    payment_timestamp = message1
+
+    # Apply the discount and check the alert thresholds from the rules file
+    payment_method = message[2]
+    category = message[3] if len(message) == 4 else None
+    outcome = rules.current().evaluate(payment_method, category, payment_amount_change)
+    new_payment = outcome.amount
+    formatted_new_payment = "${:.02f}".format(new_payment)
+
+    # Send each alert whose threshold the (discounted) payment reaches
+    for alert in outcome.alerts:
+        logger.warning(f"A {payment_method} has been used. The new price is {formatted_new_payment}.")
+        if alert.route == "email":
+            # Import function for sending email; smtplib and email are only
+            # loaded the first time an alert is emailed
+            from email_alert import createAndSendEmailAlert
+            # Create Email Parts
+            email_subject = alert.subject
+            email_body = f"A {payment_method} has been used at {payment_timestamp}. The original price was {formatted_message2}. The new price is {formatted_new_payment}."
+            createAndSendEmailAlert(email_subject, email_body)
+            logger.info("Email Sent")
+
+    if outcome.discount_percent:
+        logger.info(f"[X] {payment_method} Was Used. {outcome.discount_percent:g}% discount applied. "
+                    f"New price is {formatted_new_payment}.")
 
 # Define a main function to run the program
-def main(hn: str = "localhost", qn: str = "02-amount"):
+def main(hn: str = "localhost", qn: str = "02-amount", banner: bool = True):
     """ Continuously listen for task messages on a named queue."""
+    global rules
+    setup_logger(__file__, banner=banner)
+    rules = RulesFile("rules.toml", logger=logger)
+
+    # pika takes most of the startup time; import it only when connecting
+    import pika
+
+    deduplicator = None
 
     # When a statement can go wrong, use a try-except block
     try:
@@ -101,7 +116,13 @@ def main(hn: str = "localhost", qn: str = "02-amount"):
         # A durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # Messages will not be deleted until the consumer acknowledges
-        channel.queue_declare(queue=qn, durable=True)
+        # The settings come from queues.toml so they match the producer's
+        topology = load_topology()
+        declare_queue(channel, qn, **topology)
+
+        # Remember processed message ids so a redelivered message
+        # is not counted twice
+        deduplicator = Deduplicator(**topology["dedup"], path=f"{qn}.seen", logger=logger)
 
         # The QoS level controls the number of messages
         # that can be in-flight (unacknowledged by the consumer)
@@ -116,7 +137,12 @@ def main(hn: str = "localhost", qn: str = "02-amount"):
         # Configure the channel to listen on a specific queue,
         # use the callback function named callback,
         # and do not auto-acknowledge the message (let the callback handle it)
-        channel.basic_consume(queue=qn, on_message_callback=amount_callback, auto_ack=False)
+        # reliable_callback acks, retries or dead-letters every message
+        # so one bad message cannot stall the queue
+        on_message = reliable_callback(amount_callback, logger, qn, topology["dead_letter_exchange"],
+                                       topology["max_retries"], topology["retry_delay"],
+                                       deduplicator=deduplicator)
+        channel.basic_consume(queue=qn, on_message_callback=on_message, auto_ack=False)
 
         # Print a message to the console for the user
         logger.info(" [*] Ready for work. To exit, press CTRL+C")
@@ -136,6 +162,8 @@ def main(hn: str = "localhost", qn: str = "02-amount"):
         sys.exit(0)
     finally:
         logger.info("\nClosing connection. Goodbye.\n")
+        if deduplicator is not None:
+            deduplicator.save()
         connection.close()
 
 # Standard Python idiom to indicate the main program entry point
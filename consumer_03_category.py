@@ -8,15 +8,19 @@
 """
 
 
-import pika
 import sys
 
+from dedup import Deduplicator
+from message_handling import PoisonMessage, reliable_callback
+from queue_topology import declare_queue, load_topology
+
 
 
 # Configure logging
-from util_logger import setup_logger
+# The handlers are added in main(), so importing this module is cheap
+from util_logger import get_logger, setup_logger
 
-logger, logname = setup_logger(__file__)
+logger = get_logger(__file__)
 
 # Global Variable for Category Counts
 category_count = {
@@ -32,6 +36,7 @@ def category_callback(ch, method, properties, body):
     """ Define behavior on getting a message.
         This function will be called each time a message is received.
         The function must accept the four arguments shown here.
+        reliable_callback acks the message once this returns.
     """
     # Decode the binary message body to a string
     logger.info(f" [x] Received {body.decode()}")
@@ -46,39 +51,37 @@ def category_callback(ch, method, properties, body):
         timestamp, category = category_split
     else:
         logger.info(" [X] Invalid Category Message Format")
-        # Delete Message from Queue after Processing
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        return
+        raise PoisonMessage(f"Expected timestamp,category but got {category_message!r}")
 
     # Create Percentage of Category
-    try:
-        # Check if category is in the category_count dictionary
-        if category in category_count:
-            # Increment the count for the category
-            category_count[category] += 1
-        else:
-            logger.info(f" [X] Invalid Category: {category}")
+    # Check if category is in the category_count dictionary
+    if category in category_count:
+        # Increment the count for the category
+        category_count[category] += 1
+    else:
+        logger.info(f" [X] Invalid Category: {category}")
 
-        # Calculate the total number of purchases across all categories
-        total_purchases = sum(category_count.values())
+    # Calculate the total number of purchases across all categories
+    total_purchases = sum(category_count.values())
 
-        # Log the progress for each category and its percentage of purchases
+    # Log the progress for each category and its percentage of purchases
+    if total_purchases:
         for cat, count in category_count.items():
             percent_processed = (count / total_purchases) * 100
             formatted_category_percentage = "{:.2f}%".format(percent_processed)
             logger.info(f" [X] {cat} is purchased {formatted_category_percentage} of the time.")
-        
-    except Exception as e:
-        logger.error(" [X] An error has occurred.")
-        logger.error(f" [X] Error: {e}")
 
     # Send Confirmation Report
     logger.info("[X] Category Has Been Received and Processed.")
-    # Delete Message from Queue after Processing
-    ch.basic_ack(delivery_tag=method.delivery_tag)
 # Define a main function to run the program
-def main(hn: str = "localhost", qn: str = "task_queue"):
+def main(hn: str = "localhost", qn: str = "03-category", banner: bool = True):
     """ Continuously listen for task messages on a named queue."""
+    setup_logger(__file__, banner=banner)
+
+    # pika takes most of the startup time; import it only when connecting
+    import pika
+
+    deduplicator = None
 
     # When a statement can go wrong, use a try-except block
     try:
@@ -103,7 +106,13 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         # A durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # Messages will not be deleted until the consumer acknowledges
-        channel.queue_declare(queue=qn, durable=True)
+        # The settings come from queues.toml so they match the producer's
+        topology = load_topology()
+        declare_queue(channel, qn, **topology)
+
+        # Remember processed message ids so a redelivered message
+        # is not counted twice
+        deduplicator = Deduplicator(**topology["dedup"], path=f"{qn}.seen", logger=logger)
 
         # The QoS level controls the number of messages
         # that can be in-flight (unacknowledged by the consumer)
@@ -118,7 +127,12 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         # Configure the channel to listen on a specific queue,
         # use the callback function named callback,
         # and do not auto-acknowledge the message (let the callback handle it)
-        channel.basic_consume(queue=qn, on_message_callback=category_callback, auto_ack=False)
+        # reliable_callback acks, retries or dead-letters every message
+        # so one bad message cannot stall the queue
+        on_message = reliable_callback(category_callback, logger, qn, topology["dead_letter_exchange"],
+                                       topology["max_retries"], topology["retry_delay"],
+                                       deduplicator=deduplicator)
+        channel.basic_consume(queue=qn, on_message_callback=on_message, auto_ack=False)
 
         # Print a message to the console for the user
         logger.info(" [*] Ready for work. To exit, press CTRL+C")
@@ -138,6 +152,8 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         sys.exit(0)
     finally:
         logger.info("\nClosing connection. Goodbye.\n")
+        if deduplicator is not None:
+            deduplicator.save()
         connection.close()
 
 # Standard Python idiom to indicate the main program entry point
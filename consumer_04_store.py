@@ -0,0 +1,219 @@
+"""
+    This program listens for complete transactions and writes them to the
+    local transaction store (transaction_store.py), where they can be
+    queried in milliseconds.
+
+    Messages are written in batches. A message is only acknowledged once
+    the batch holding it has been committed to the database, so nothing is
+    lost if the consumer stops half way through a batch.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+
+"""
+
+import sqlite3
+import sys
+
+from dedup import Deduplicator
+from message_handling import PoisonMessage, reliable_callback
+from queue_topology import declare_queue, load_topology
+from transaction_store import TransactionStore
+
+# Configure logging
+# The handlers are added in main(), so importing this module is cheap
+from util_logger import get_logger, setup_logger
+
+logger = get_logger(__file__)
+
+# Rows written to the database per transaction
+BATCH_SIZE = 500
+# The most seconds a message waits before its batch is written
+FLUSH_INTERVAL = 1.0
+
+# Global Variables for the store, the processed message ids,
+# the ids of the buffered messages and the newest message not yet acknowledged
+store = None
+deduplicator = None
+buffered_ids = {}
+unacked_tag = None
+
+def mark_stored():
+    """Remember the ids of the buffered messages, once their rows are committed."""
+    if deduplicator is not None:
+        for message_id in buffered_ids:
+            deduplicator.mark(message_id)
+    buffered_ids.clear()
+
+def commit_batch(ch):
+    """Write the buffered transactions and acknowledge every message in them."""
+    global unacked_tag
+    try:
+        count = store.flush()
+    except sqlite3.Error as e:
+        # The rows stay buffered and their messages unacknowledged, so the
+        # acknowledgement below can never cover a row that was not written.
+        # The timer tries again; meanwhile prefetch_count stops deliveries
+        # once a whole batch is waiting.
+        logger.error(f"[X] Could not store {len(store.buffer)} transactions, will try again: {e}")
+        return
+    # Only mark the ids once the rows are in the database, and before the
+    # ack, so a redelivered copy is dropped but a lost row never is
+    mark_stored()
+    if unacked_tag is not None:
+        # multiple=True acknowledges everything up to and including this message
+        ch.basic_ack(delivery_tag=unacked_tag, multiple=True)
+        unacked_tag = None
+    if deduplicator is not None:
+        deduplicator.maybe_save()
+    if count:
+        logger.info(f"[X] Stored {count} transactions.")
+
+# Define a callback function to be called when a message is received
+def store_callback(ch, method, properties, body):
+    """ Define behavior on getting a message.
+        This function will be called each time a message is received.
+        The function must accept the four arguments shown here.
+        The message is acknowledged when its batch is committed.
+    """
+    global unacked_tag
+
+    # Decode the binary message body to a string
+    message = body.decode()
+    # Split Message
+    message_split = message.split(",")
+    # Check if the message has the expected format (timestamp,method,amount,category)
+    if len(message_split) != 4:
+        raise PoisonMessage(f"Expected timestamp,method,amount,category but got {message!r}")
+    timestamp, payment_method, payment_amount, category = message_split
+    # A copy of a message in the current batch (the producer sent the row
+    # twice) is not marked yet; it is acked with the batch, not stored again
+    if properties.message_id in buffered_ids:
+        logger.info(f" [dedup] Skipping {properties.message_id}, it is already in this batch")
+        unacked_tag = method.delivery_tag
+        return
+    try:
+        # Only buffer the row here; commit_batch writes it, so a failed
+        # write is not mistaken for a failure of this message
+        store.add(timestamp, payment_method, payment_amount, category, flush=False)
+    except ValueError as e:
+        raise PoisonMessage(f"Invalid transaction {message!r}: {e}")
+
+    unacked_tag = method.delivery_tag
+    if properties.message_id:
+        buffered_ids[properties.message_id] = None
+    # Write the buffer when it is full or old enough
+    if store.full() or store.due():
+        commit_batch(ch)
+
+# Define a main function to run the program
+def main(hn: str = "localhost", qn: str = "04-store", db: str = "transactions.db", banner: bool = True):
+    """ Continuously listen for task messages on a named queue."""
+    global store, deduplicator
+    setup_logger(__file__, banner=banner)
+
+    # pika takes most of the startup time; import it only when connecting
+    import pika
+
+    # When a statement can go wrong, use a try-except block
+    try:
+        # Try this code, if it works, keep going
+        # Create a blocking connection to the RabbitMQ server
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hn))
+
+    # Except, if there's an error, do this
+    except Exception as e:
+        print()
+        logger.error("ERROR: Connection to RabbitMQ server failed.")
+        logger.error(f"Verify the server is running on host={hn}.")
+        logger.error(f"The error says: {e}")
+        print()
+        sys.exit(1)
+
+    try:
+        store = TransactionStore(db, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL)
+
+        # Use the connection to create a communication channel
+        channel = connection.channel()
+
+        # Use the channel to declare a durable queue
+        # A durable queue will survive a RabbitMQ server restart
+        # and help ensure messages are processed in order
+        # Messages will not be deleted until the consumer acknowledges
+        # The settings come from queues.toml so they match the producer's
+        topology = load_topology()
+        declare_queue(channel, qn, **topology)
+
+        # Remember processed message ids so a redelivered message
+        # is not counted twice
+        deduplicator = Deduplicator(**topology["dedup"], path=f"{qn}.seen", autosave=False, logger=logger)
+
+        # The QoS level controls the number of messages
+        # that can be in-flight (unacknowledged by the consumer)
+        # at any given time.
+        # Messages stay unacknowledged until their batch is written,
+        # so allow a whole batch to be in flight.
+        # prefetch_count = Per consumer limit of unacknowledged messages
+        channel.basic_qos(prefetch_count=BATCH_SIZE)
+
+        # Write a partial batch when traffic is slow so messages
+        # do not sit unacknowledged waiting for a full one
+        def commit_on_timer():
+            if store.due():
+                commit_batch(channel)
+            connection.call_later(FLUSH_INTERVAL, commit_on_timer)
+
+        connection.call_later(FLUSH_INTERVAL, commit_on_timer)
+
+        # Configure the channel to listen on a specific queue,
+        # use the callback function named callback,
+        # and do not auto-acknowledge the message (let the callback handle it)
+        # reliable_callback retries or dead-letters messages that fail;
+        # store_callback acknowledges the rest once they are written
+        on_message = reliable_callback(store_callback, logger, qn, topology["dead_letter_exchange"],
+                                       topology["max_retries"], topology["retry_delay"],
+                                       ack_on_success=False,
+                                       deduplicator=deduplicator)
+        channel.basic_consume(queue=qn, on_message_callback=on_message, auto_ack=False)
+
+        # Print a message to the console for the user
+        logger.info(" [*] Ready for work. To exit, press CTRL+C")
+
+        # Start consuming messages via the communication channel
+        channel.start_consuming()
+
+    # Except, in the event of an error OR user stops the process, do this
+    except Exception as e:
+        print()
+        logger.error("ERROR: Something went wrong.")
+        logger.error(f"The error says: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print()
+        logger.info("User interrupted the continuous listening process.")
+        # Keep what has been received; it is acknowledged before we go
+        if store is not None:
+            commit_batch(channel)
+        sys.exit(0)
+    finally:
+        logger.info("\nClosing connection. Goodbye.\n")
+        if store is not None:
+            try:
+                store.close()
+                # Stored but not acknowledged: remember the ids so the
+                # copies RabbitMQ delivers again are dropped
+                mark_stored()
+            except sqlite3.Error as e:
+                # Not acknowledged, so RabbitMQ delivers these again
+                logger.error(f"Could not store the last transactions, they will be redelivered: {e}")
+        if deduplicator is not None:
+            deduplicator.save()
+        connection.close()
+
+# Standard Python idiom to indicate the main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+    # Call the main function with the information needed
+    main("localhost", "04-store")
@@ -0,0 +1,309 @@
+"""
+    Drop redelivered messages so the consumers count every transaction once.
+
+    RabbitMQ delivers at least once. After a lost connection or a producer
+    restart (see replay_cursor) a consumer can get the same message again,
+    and would count it twice or send a second alert email. The producer
+    gives every message an id ("<input file>:<run id>:<row number>", the
+    run id staying the same while a production run resumes), and the
+    consumers remember the ids they have processed here.
+
+    Remembering every id would grow without limit, so two structures with
+    fixed memory are used instead:
+
+    - RecentIds: an exact LRU set of the last few thousand ids. Most
+      redeliveries arrive within a few messages of the original, and
+      these are always caught exactly.
+    - RotatingBloomFilter: every id of the last one to two time windows,
+      in a fixed number of bits. It never misses an id it has seen, but
+      says "seen" for an id it has not seen with probability error_rate.
+
+    A message is a duplicate if its id is in RecentIds, or in the Bloom
+    filter. The second case may be wrong, with probability error_rate
+    (one in a million by default). Such a hit is logged, so a dropped
+    message can be traced.
+
+    Cost per message (Python 3.11, one core):
+
+    - memory: error_rate=1e-6 needs 28.8 bits and 20 hash probes per id.
+      With capacity=1,000,000 ids per window each of the two generations
+      takes 3.6 MB, so 7.2 MB in all, plus about 1.5 MB for 10,000 recent
+      ids. Memory does not grow with traffic: a generation is retired
+      when its window ends or when it holds capacity ids, whichever comes
+      first, so the error rate holds even above capacity ids per window.
+    - CPU: a duplicate caught by RecentIds costs one dict lookup (under
+      1 microsecond). Anything else costs one BLAKE2b hash and up to 20
+      bit probes per generation, and a new id 20 more bit sets to mark
+      it: about 10 microseconds in all for a new message, so the
+      consumers can still handle about 100,000 messages per second.
+
+    The state is saved to a file every save_every seconds and when the
+    consumer stops, and loaded when it starts. The file is plain data, not
+    a pickle: one line of JSON (the settings, the window start, the
+    recent ids and the id count of each generation) followed by the raw
+    bits of each generation. A file that cannot be read, or was saved with
+    other settings, is ignored and the consumer starts with an empty set. In between, every id is
+    appended to "<path>.journal" as soon as it is marked, which is before
+    the message is acked, and the journal is replayed on load. So a
+    consumer that crashes after sending an alert email, but before the
+    ack, skips the redelivered message instead of sending the email again.
+    (The journal is flushed to the operating system, not synced to disk:
+    it survives the consumer crashing, not the machine losing power.) Only
+    a crash between processing a message and marking it can still lead to
+    it being processed twice.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+
+class BloomFilter:
+    """
+    A fixed-size set of ids that can only answer "maybe seen" or "not seen".
+
+    Parameters:
+        capacity (int): ids it is sized for
+        error_rate (float): chance of "maybe seen" for a new id at capacity
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: str) -> list:
+        """The bits that represent key."""
+        # Double hashing: the k probes are h1 + i * h2 for two 64-bit halves
+        # of a single BLAKE2b digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, positions: list):
+        bits = self.bits
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def has(self, positions: list) -> bool:
+        bits = self.bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class RotatingBloomFilter:
+    """
+    Bloom filters for the current and the previous time window.
+
+    Ids are added to the current generation. When the window ends, or the
+    current generation is full, the oldest generation is dropped and a new
+    empty one starts, so an id is remembered for one to two windows.
+
+    Parameters:
+        window (float): seconds in each window
+        capacity (int): ids per generation
+        error_rate (float): false "seen" rate of a full generation
+        generations (int): windows kept, including the current one
+    """
+
+    def __init__(self, window: float = 3600.0, capacity: int = 1_000_000, error_rate: float = 1e-6,
+                 generations: int = 2, clock=time.time):
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.clock = clock
+        self.filters = [BloomFilter(capacity, error_rate) for _ in range(generations)]
+        self.started = clock()
+
+    def _rotate_if_due(self):
+        if self.clock() - self.started >= self.window or self.filters[0].count >= self.capacity:
+            self.filters.pop()
+            self.filters.insert(0, BloomFilter(self.capacity, self.error_rate))
+            self.started = self.clock()
+
+    def positions(self, key: str) -> list:
+        """The bits that represent key; the same in every generation."""
+        return self.filters[0].positions(key)
+
+    def add(self, positions: list):
+        self._rotate_if_due()
+        self.filters[0].add(positions)
+
+    def has(self, positions: list) -> bool:
+        return any(bloom.has(positions) for bloom in self.filters)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(bloom.bits) for bloom in self.filters)
+
+
+class RecentIds:
+    """An exact set of the most recently marked ids, dropping the oldest past maxsize."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+
+    def add(self, key: str):
+        self.ids[key] = None
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.maxsize:
+            self.ids.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.ids
+
+
+class Deduplicator:
+    """
+    Remembers processed message ids within a time window, in fixed memory.
+
+    Call seen(id) before processing a message and mark(id) after it was
+    processed, so a message that failed is not mistaken for a duplicate
+    when it is retried.
+
+    Parameters:
+        window (float): seconds an id is remembered for, at least (less if more
+            than capacity ids arrive in a window)
+        capacity (int): ids expected per window
+        error_rate (float): chance a new id is taken for a duplicate
+        recent (int): ids kept in the exact LRU set
+        path (str): file to save the state to, None to keep it in memory only
+        save_every (float): seconds between saves
+        autosave (bool): save from mark(); turn off to choose when to
+            save with maybe_save(), e.g. only after a batch is committed
+        logger: where to log probable (Bloom-only) duplicates
+    """
+
+    def __init__(self, window: float = 3600.0, capacity: int = 1_000_000, error_rate: float = 1e-6,
+                 recent: int = 10000, path: str = None, save_every: float = 30.0, autosave: bool = True,
+                 logger=None):
+        self.path = path
+        self.save_every = save_every
+        self.autosave = autosave
+        self.logger = logger
+        self.recent = RecentIds(recent)
+        self.bloom = RotatingBloomFilter(window, capacity, error_rate)
+        self.last_save = time.monotonic()
+        self.duplicates = 0
+        self._positions = (None, None)
+        self.journal = None
+        if path:
+            self.load()
+            self.journal = open(f"{path}.journal", "a")
+
+    def seen(self, message_id: str) -> bool:
+        """True if a message with this id was already processed."""
+        if message_id in self.recent:
+            self.duplicates += 1
+            return True
+        self._positions = (message_id, self.bloom.positions(message_id))
+        if self.bloom.has(self._positions[1]):
+            self.duplicates += 1
+            if self.logger:
+                self.logger.warning(f" [dedup] {message_id} is probably a duplicate (older than the "
+                                    f"{self.recent.maxsize} most recent ids); skipping it")
+            return True
+        return False
+
+    def mark(self, message_id: str):
+        """Remember that the message with this id was processed; call it before the ack."""
+        self._remember(message_id)
+        if self.journal is not None:
+            self.journal.write(message_id + "\n")
+            self.journal.flush()
+        if self.autosave:
+            self.maybe_save()
+
+    def _remember(self, message_id: str):
+        self.recent.add(message_id)
+        # reuse the hash from seen() when it was for the same id
+        key, positions = self._positions
+        self.bloom.add(positions if key == message_id else self.bloom.positions(message_id))
+
+    def maybe_save(self):
+        """Save the state if save_every seconds have passed since the last save."""
+        if self.path and time.monotonic() - self.last_save >= self.save_every:
+            self.save()
+
+    def save(self):
+        """Write the state to path atomically and empty the journal."""
+        temporary = f"{self.path}.tmp"
+        bloom = self.bloom
+        header = {
+            "window": bloom.window,
+            "capacity": bloom.capacity,
+            "error_rate": bloom.error_rate,
+            "started": bloom.started,
+            "counts": [generation.count for generation in bloom.filters],
+            "recent": list(self.recent.ids),
+        }
+        with open(temporary, "wb") as file_object:
+            file_object.write(json.dumps(header).encode() + b"\n")
+            for generation in bloom.filters:
+                file_object.write(generation.bits)
+        os.replace(temporary, self.path)
+        # Everything in the journal is in the saved state now (a crash
+        # before this line only means replaying ids we already have)
+        if self.journal is not None:
+            self.journal.truncate(0)
+        self.last_save = time.monotonic()
+
+    def load(self):
+        """Read the state from path if it was saved with the same settings, then replay the journal."""
+        try:
+            self._load_state()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            # Whatever is wrong with the file (cut short, another format,
+            # edited by hand), the consumer must still start
+            if self.logger:
+                self.logger.warning(f" [dedup] Could not read {self.path}, starting with no ids: {e!r}")
+        # ids marked after the last save
+        try:
+            with open(f"{self.path}.journal", "r", errors="replace") as file_object:
+                for line in file_object:
+                    # a line cut short by a crash has no newline; its message was not acked
+                    if line.endswith("\n"):
+                        self._remember(line[:-1])
+        except FileNotFoundError:
+            pass
+
+    def _load_state(self):
+        """Read the file written by save(), keeping it only if the settings match."""
+        bloom = self.bloom
+        with open(self.path, "rb") as file_object:
+            header = json.loads(file_object.readline())
+            if (header["window"], header["capacity"], header["error_rate"]) != (bloom.window, bloom.capacity,
+                                                                               bloom.error_rate):
+                return
+            if len(header["counts"]) != len(bloom.filters):
+                return
+            filters = []
+            for count in header["counts"]:
+                generation = BloomFilter(bloom.capacity, bloom.error_rate)
+                bits = file_object.read(len(generation.bits))
+                if len(bits) != len(generation.bits):
+                    raise ValueError("the file is cut short")
+                generation.bits[:] = bits
+                generation.count = int(count)
+                filters.append(generation)
+            started = float(header["started"])
+            recent = [str(message_id) for message_id in header["recent"]]
+        bloom.filters, bloom.started = filters, started
+        for message_id in recent:
+            self.recent.add(message_id)
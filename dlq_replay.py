@@ -0,0 +1,125 @@
+"""
+    This program looks at the dead-letter queue of a queue and sends its
+    messages back to be processed again, once whatever made them fail has
+    been fixed.
+
+    Usage:
+        python dlq_replay.py 02-amount --list        show what is there and why
+        python dlq_replay.py 02-amount               replay everything
+        python dlq_replay.py 02-amount --limit 10    replay the first 10
+
+    Only the messages in the dead-letter queue when the program starts are
+    replayed, so a message that fails again is not replayed over and over.
+    Messages are republished with broker confirms before they are acked,
+    so nothing is lost if the program stops half way.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import argparse
+import sys
+
+from message_handling import copy_properties
+from queue_topology import dead_letter_queue_name
+
+# Configure logging
+from util_logger import get_logger, setup_logger
+
+logger = get_logger(__file__)
+
+# Headers added when a message is dead-lettered; dropped on replay
+FAILURE_HEADERS = ("x-failure-reason", "x-exception", "x-original-queue", "x-retry-count", "x-death",
+                   "x-first-death-exchange", "x-first-death-queue", "x-first-death-reason",
+                   "x-last-death-exchange", "x-last-death-queue", "x-last-death-reason")
+
+
+def describe(properties) -> str:
+    """Summarize why a dead-lettered message failed."""
+    headers = properties.headers or {}
+    if "x-failure-reason" in headers:
+        return (f"{headers.get('x-exception', 'Error')}: {headers['x-failure-reason']} "
+                f"(after {headers.get('x-retry-count', 0)} retries)")
+    # rejected or dropped by the broker rather than by a consumer
+    if "x-first-death-reason" in headers:
+        return f"dead-lettered by the broker: {headers['x-first-death-reason']}"
+    return "no reason recorded"
+
+
+def replay(host: str, queue: str, limit: int = None, list_only: bool = False) -> int:
+    """
+    Replay (or just list) the dead-lettered messages of a queue.
+
+    Parameters:
+        host (str): the host name or IP address of the RabbitMQ server
+        queue (str): the queue whose dead letters to replay
+        limit (int): the most messages to handle (default: all)
+        list_only (bool): log the messages and leave them in place
+    Returns the number of messages handled.
+    """
+    import pika
+
+    dead_letters = dead_letter_queue_name(queue)
+    try:
+        conn = pika.BlockingConnection(pika.ConnectionParameters(host))
+    except pika.exceptions.AMQPConnectionError as e:
+        logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
+        sys.exit(1)
+
+    try:
+        ch = conn.channel()
+        ch.confirm_delivery()
+        waiting = ch.queue_declare(queue=dead_letters, passive=True).method.message_count
+        todo = waiting if limit is None else min(limit, waiting)
+        logger.info(f"{waiting} messages in {dead_letters}, handling {todo}")
+
+        handled = 0
+        while handled < todo:
+            method, properties, body = ch.basic_get(queue=dead_letters, auto_ack=False)
+            if method is None:
+                break
+            handled += 1
+            logger.info(f" [{handled}] {body.decode(errors='replace')} - {describe(properties)}")
+            if list_only:
+                continue
+            headers = {key: value for key, value in (properties.headers or {}).items()
+                       if key not in FAILURE_HEADERS}
+            original_queue = (properties.headers or {}).get("x-original-queue", queue)
+            ch.basic_publish(exchange="", routing_key=original_queue, body=body,
+                             properties=copy_properties(properties, headers or None))
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        if list_only:
+            # put everything we looked at back in the dead-letter queue
+            ch.basic_recover(requeue=True)
+        else:
+            logger.info(f"Replayed {handled} messages from {dead_letters} to {queue}")
+        return handled
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="List or replay dead-lettered messages.")
+    parser.add_argument("queue", help="the queue whose dead letters to replay, e.g. 02-amount")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--limit", type=int, default=None, help="the most messages to handle")
+    parser.add_argument("--list", action="store_true", help="only show the messages and why they failed")
+    parser.add_argument("--no-banner", dest="banner", action="store_false",
+                        help="do not log the date, platform and Python details at startup")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command line entry point (also the sales-dlq-replay console script)."""
+    args = parse_args(argv)
+    setup_logger(__file__, banner=args.banner)
+    replay(args.host, args.queue, limit=args.limit, list_only=args.list)
+
+
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+    main()
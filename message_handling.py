@@ -0,0 +1,123 @@
+"""
+    Error handling shared by the consumers.
+
+    A callback that raised used to log the error and leave the message
+    unacknowledged. With prefetch_count=1 that stalls the consumer for
+    good. reliable_callback wraps a consumer callback so that every
+    message is settled one way or another:
+
+    - the message id was already processed (see dedup): the message is
+      acked without calling the callback
+    - the callback returns: the message is acked
+    - the callback raises PoisonMessage (the message can never be
+      processed, e.g. a malformed amount): the message goes straight to
+      the dead-letter queue
+    - the callback raises anything else: the message is retried after
+      retry_delay seconds, up to max_retries times, then dead-lettered
+
+    Retries go through "<queue>.retry" (see queue_topology). It holds each
+    message for retry_delay seconds and then dead-letters it back onto the
+    original queue, so the consumer never sleeps waiting for a retry.
+
+    Dead-lettered messages keep their body and properties. These headers
+    say what went wrong:
+
+    - x-failure-reason: the exception message
+    - x-exception: the exception type
+    - x-original-queue: the queue the message failed on
+    - x-retry-count: how many times it was retried
+
+    Use dlq_replay.py to look at the dead-letter queue and send its
+    messages back once the problem is fixed.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+from queue_topology import retry_queue_name
+
+
+class PoisonMessage(ValueError):
+    """A message that can never be processed; it is dead-lettered without retries."""
+
+
+def copy_properties(properties, headers: dict):
+    """Copy message properties, replacing the headers."""
+    # Imported here so the consumers load pika only when they connect
+    import pika
+
+    return pika.BasicProperties(
+        content_type=properties.content_type,
+        content_encoding=properties.content_encoding,
+        delivery_mode=properties.delivery_mode or pika.DeliveryMode.Persistent,
+        correlation_id=properties.correlation_id,
+        message_id=properties.message_id,
+        timestamp=properties.timestamp,
+        type=properties.type,
+        app_id=properties.app_id,
+        headers=headers,
+    )
+
+
+def reliable_callback(callback, logger, queue: str, dead_letter_exchange: str = "transactions.dlx",
+                      max_retries: int = 3, retry_delay: float = 5.0, ack_on_success: bool = True,
+                      deduplicator=None):
+    """
+    Wrap a consumer callback with acks, bounded retries and dead-lettering.
+
+    The wrapped callback must not ack the message itself, unless
+    ack_on_success is False: then the callback acks messages it processed
+    (e.g. in batches), and marks their ids with the deduplicator once they
+    are done for good (e.g. committed). Only failed messages are settled here.
+
+    Parameters:
+        callback: function(ch, method, properties, body) that processes a message
+        logger: where to log failures
+        queue (str): the queue being consumed
+        dead_letter_exchange (str): exchange the dead-letter queue is bound to
+        max_retries (int): retries before a failing message is dead-lettered
+        retry_delay (float): seconds between retries (0 to dead-letter at once)
+        ack_on_success (bool): ack messages the callback processed
+        deduplicator: a dedup.Deduplicator to skip redelivered messages, or None
+    """
+
+    def on_message(ch, method, properties, body):
+        message_id = properties.message_id if deduplicator is not None else None
+        if message_id and deduplicator.seen(message_id):
+            logger.info(f" [dedup] Skipping {message_id}, it was already processed")
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        try:
+            callback(ch, method, properties, body)
+            # marked (and journaled) before the ack, so a crash in between
+            # cannot lead to the message being processed again
+            if message_id and ack_on_success:
+                deduplicator.mark(message_id)
+            if not ack_on_success:
+                return
+        except Exception as e:
+            headers = dict(properties.headers or {})
+            retries = headers.get("x-retry-count", 0)
+            if not isinstance(e, PoisonMessage) and retries < max_retries and retry_delay > 0:
+                logger.warning(f" [retry] {body!r} failed ({e}); retry {retries + 1} of {max_retries} "
+                               f"in {retry_delay:g}s")
+                headers["x-retry-count"] = retries + 1
+                ch.basic_publish(exchange="", routing_key=retry_queue_name(queue), body=body,
+                                 properties=copy_properties(properties, headers))
+            elif dead_letter_exchange:
+                logger.error(f" [dead-letter] {body!r} failed after {retries} retries: {e}")
+                headers.update({
+                    "x-failure-reason": str(e),
+                    "x-exception": type(e).__name__,
+                    "x-original-queue": queue,
+                    "x-retry-count": retries,
+                })
+                ch.basic_publish(exchange=dead_letter_exchange, routing_key=queue, body=body,
+                                 properties=copy_properties(properties, headers))
+            else:
+                logger.error(f" [dropped] {body!r} failed after {retries} retries and there is "
+                             f"no dead-letter exchange: {e}")
+        # Settle the message in every case so the queue keeps moving
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    return on_message
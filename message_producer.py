@@ -6,29 +6,99 @@
     Date: 2023-10-03
 """
 
-import pika
 import sys
-import webbrowser
 import csv
+import os
+import secrets
 import time
+import argparse
+import itertools
+from collections import deque
+
+from backpressure import Backpressure, ManagementApiProbe, PassiveDeclareProbe
+from queue_topology import declare_queues, delete_queues, load_topology
+from replay_cursor import ReplayCursor, file_fingerprint
+from traffic_shaper import Pacer, constant_profile, make_profile
 
 
 # Configure logging
-from util_logger import setup_logger
+# The handlers are added in main(), so importing this module is cheap
+from util_logger import get_logger, setup_logger
 
-logger, logname = setup_logger(__file__)
+logger = get_logger(__file__)
 
 SHOW_OFFER = True
 
 def offer_rabbitmq_admin_site():
     """Offer to open the RabbitMQ Admin website"""
+    import webbrowser
+
     ans = input("Would you like to monitor RabbitMQ queues? y or n ")
     logger.info("Seeing if you want to monitor RabbitMQ queues")
     if ans.lower() == "y":
         webbrowser.open_new("http://localhost:15672/#/queues")
         logger.info(f"Answer is {ans}.")
 
-def send_message(host: str, first_queue_name: str, second_queue_name: str, third_queue_name: str, input_file: str):
+def publish_pending(ch, pending: dict, backpressure=None, max_pending: int = 1000, drain: bool = False,
+                    published: dict = None, sleep=time.sleep):
+    """
+    Publish the messages waiting for each queue, as far as backpressure allows.
+
+    A queue that is paused or throttled keeps its messages in pending while
+    the other queues carry on. Once more than max_pending messages wait for
+    one queue (or when drain is set) we block until that queue is ready.
+
+    Parameters:
+        ch: the channel to publish on
+        pending (dict): queue name -> deque of (message, encoded body, message id)
+        backpressure: a backpressure.Backpressure, or None to publish everything
+        max_pending (int): messages to hold per queue before blocking
+        drain (bool): block until every pending message is published
+        published (dict): queue name -> count of messages published, updated here
+        sleep: how to wait for a queue that refused a message when there is
+            no backpressure (pass connection.sleep to keep the connection alive)
+
+    With publisher confirms on, a message the broker refuses (a full queue
+    with overflow = "reject-publish") is put back at the front of its
+    queue's pending messages and tried again once the queue has room.
+    """
+    import pika
+
+    for queue_name, messages in pending.items():
+        while messages:
+            if backpressure is not None and not backpressure.ready(queue_name):
+                if not drain and len(messages) <= max_pending:
+                    break
+                backpressure.wait(queue_name)
+            message, body, message_id = messages.popleft()
+            # use the channel to publish a message to the queue
+            # every message passes through an exchange
+            # the message id lets consumers drop redelivered copies
+            try:
+                ch.basic_publish(exchange="", routing_key=queue_name, body=body,
+                                 properties=pika.BasicProperties(message_id=message_id))
+            except (pika.exceptions.NackError, pika.exceptions.UnroutableError):
+                # not queued; keep it and back off until the queue has room
+                messages.appendleft((message, body, message_id))
+                if backpressure is not None:
+                    backpressure.rejected(queue_name)
+                else:
+                    logger.warning(f" [x] {queue_name} is full and refused {message}; trying again in 1s")
+                    sleep(1.0)
+                continue
+            if backpressure is not None:
+                backpressure.published(queue_name)
+            if published is not None:
+                published[queue_name] += 1
+            # print a message to the console for the user
+            logger.info(f" [x] Sent {message} to {queue_name}")
+
+def send_message(host: str, first_queue_name: str, second_queue_name: str, third_queue_name: str, input_file: str,
+                 profile=None, report_every: float = 10.0, monitor: str = "passive",
+                 max_queue_depth: int = 10000, resume_queue_depth: int = None, max_pending: int = 1000,
+                 startup: str = "dev", cursor_file: str = "producer.cursor", topology: dict = None,
+                 store_queue_name: str = None, management_url: str = None,
+                 management_user: str = "guest", management_password: str = "guest"):
     """
     Creates and sends a message to the queue each execution.
     This process runs and finishes.
@@ -37,78 +107,257 @@ def send_message(host: str, first_queue_name: str, second_queue_name: str, third
         host (str): the host name or IP address of the RabbitMQ server
         queue_names (str): the names of the queue's to send the message to
         input_file: the name of the file to read the messages from
+        profile: a traffic_shaper profile deciding when each row is sent
+            (default: one row every 15 seconds)
+        report_every (float): seconds between actual vs target rate reports
+        monitor (str): how to watch queue depth: "passive" (queue_declare),
+            "api" (management API) or "off" to publish blindly
+        max_queue_depth (int): depth at which publishing to a queue pauses
+        resume_queue_depth (int): depth at which it resumes (default: half)
+        max_pending (int): messages held for a paused queue before blocking
+        startup (str): "dev" deletes the queues (and their retry and
+            dead-letter queues) and sends the whole file;
+            "production" keeps the queues and their backlog, and resumes
+            from the replay cursor
+        cursor_file (str): where production mode remembers its position ("" for none)
+        topology (dict): queue settings (default: read from queues.toml)
+        store_queue_name (str): queue that gets each whole transaction for
+            the transaction store (consumer_04_store.py), None to skip it
+        management_url (str): monitor "api": the management site
+            (default: port 15672 on host)
+        management_user (str), management_password (str): monitor "api": its login
     """
+    # pika takes most of the startup time; import it only when connecting
+    import pika
+
+    if profile is None:
+        profile = constant_profile(1 / 15)
+    cursor = None
+    conn = None
 
     try:
         # create a blocking connection to the RabbitMQ server
         conn = pika.BlockingConnection(pika.ConnectionParameters(host))
         # use the connection to create a communication channel
         ch = conn.channel()
-        
-        # delete the queue if it already exists
-        # this is a convenience to clear the queue before running        
-        ch.queue_delete(queue=first_queue_name)
-        ch.queue_delete(queue=second_queue_name)
-        ch.queue_delete(queue=third_queue_name)
+        # wait between rows with conn.sleep rather than time.sleep, so pika
+        # keeps answering the server's heartbeats while the producer is idle
+        pacer = Pacer(logger, report_every=report_every, sleep=conn.sleep)
+
+        queue_names = [first_queue_name, second_queue_name, third_queue_name]
+        if store_queue_name:
+            queue_names.append(store_queue_name)
+        if startup == "dev":
+            # delete the queues if they already exist, with their retry and
+            # dead-letter queues, so changed settings in queues.toml apply
+            # this is a convenience to clear the queue before running
+            delete_queues(ch, queue_names)
         # use the channel to declare a durable queue
         # a durable queue will survive a RabbitMQ server restart
         # and help ensure messages are processed in order
         # messages will not be deleted until the consumer acknowledges
-        ch.queue_declare(queue=first_queue_name, durable=True)
-        ch.queue_declare(queue=second_queue_name, durable=True)
-        ch.queue_declare(queue=third_queue_name, durable=True)
+        # declaring again with the same settings keeps the queue and its backlog
+        declare_queues(ch, queue_names, topology if topology is not None else load_topology())
+
+        # in production, have the broker confirm every publish so the
+        # replay cursor only moves past rows that are safely queued
+        start_row = 0
+        if startup == "production":
+            ch.confirm_delivery()
+            if cursor_file:
+                cursor = ReplayCursor(cursor_file, input_file)
+                start_row = cursor.load()
+                logger.info(f"Resuming from row {start_row} of {input_file}")
+
+        # watch queue depth so a slow consumer slows the producer down
+        # instead of filling up the broker
+        backpressure = None
+        if monitor != "off":
+            if monitor == "api":
+                probe = ManagementApiProbe(management_url or f"http://{host}:15672",
+                                           user=management_user, password=management_password)
+            else:
+                probe = PassiveDeclareProbe(ch)
+            # wait out pauses with conn.sleep so heartbeats are still answered
+            backpressure = Backpressure(probe, queue_names, high_watermark=max_queue_depth,
+                                        low_watermark=resume_queue_depth, logger=logger,
+                                        report_every=report_every, sleep=conn.sleep)
+        pending = {queue_name: deque() for queue_name in queue_names}
+        published = {queue_name: 0 for queue_name in queue_names}
+
+        # messages are identified by file name, run and row number. A row
+        # sent again when production resumes gets the same id as before, so
+        # the consumers drop the copy; a new run (every dev start, a
+        # --restart, a regenerated file) gets new ids so nothing is dropped
+        source_name = os.path.basename(input_file)
+        if cursor is not None:
+            run_id = cursor.run_id
+        elif startup == "production":
+            # no cursor: the same file always makes the same ids
+            run_id = file_fingerprint(input_file)[0]
+        else:
+            run_id = secrets.token_hex(4)
+
         # Read the tasks.csv file and send each task to the queue
         with open(input_file, 'r') as input_file:
             reader = csv.reader(input_file)
             # skip the header row
             header = next(reader)
             logger.info("Skipping header row")
-            # for each row in the file
-            for row in reader:
+            # skip the rows a previous run already sent
+            reader = itertools.islice(reader, start_row, None)
+            # for each row in the file, sent when the traffic profile says so
+            for row_number, row in enumerate(pacer.run(profile(reader)), start=start_row):
                 # get row variables
                 Payment_Method, Payment_Amount, Category, Timestamp = row             
                        
                 # create a message to send to the queue
                 message1 = Timestamp, Payment_Method
-                message2 = Timestamp, Payment_Amount, Payment_Method
+                message2 = Timestamp, Payment_Amount, Payment_Method, Category
                 message3 = Timestamp, Category
+                message4 = Timestamp, Payment_Method, Payment_Amount, Category
                 
                 # encode the messages
                 message1_encode = "," .join(message1).encode()
                 message2_encode = "," .join(message2).encode()
                 message3_encode = "," .join(message3).encode()              
+                message4_encode = "," .join(message4).encode()
+                message_id = f"{source_name}:{run_id}:{row_number}"
                 
-                # use the channel to publish a message to the queue
-                # every message passes through an exchange
-                ch.basic_publish(exchange="", routing_key=first_queue_name, body=message1_encode)
-                # print a message to the console for the user
-                logger.info(f" [x] Sent {message1} to {first_queue_name}")
-                # use the channel to publish a message to the queue
-                ch.basic_publish(exchange="", routing_key=second_queue_name, body=message2_encode)
-                # print a message to the console for the user
-                logger.info(f" [x] Sent {message2} to {second_queue_name}")
-                # use the channel to publish a message to the queue
-                ch.basic_publish(exchange="", routing_key=third_queue_name, body=message3_encode)
-                # print a message to the console for the user
-                logger.info(f" [x] Sent {message3} to {third_queue_name}")
-                # Wait 15 seconds between each message
-                time.sleep(15)
-                
+                # queue the messages and publish whatever backpressure allows
+                pending[first_queue_name].append((message1, message1_encode, message_id))
+                pending[second_queue_name].append((message2, message2_encode, message_id))
+                pending[third_queue_name].append((message3, message3_encode, message_id))
+                if store_queue_name:
+                    pending[store_queue_name].append((message4, message4_encode, message_id))
+                publish_pending(ch, pending, backpressure, max_pending, published=published,
+                                sleep=conn.sleep)
+                if cursor is not None:
+                    # a row is done once its message reached every queue
+                    cursor.advance_to(start_row + min(published.values()))
+
+            # publish anything still held back for a slow queue
+            publish_pending(ch, pending, backpressure, max_pending, drain=True, published=published,
+                            sleep=conn.sleep)
+            if cursor is not None:
+                cursor.advance_to(start_row + min(published.values()))
+
     except pika.exceptions.AMQPConnectionError as e:
         logger.error(f"Error: Connection to RabbitMQ server failed: {e}")
         sys.exit(1)
+    except pika.exceptions.ChannelClosedByBroker as e:
+        if e.reply_code == 406:
+            # PRECONDITION_FAILED: the queue exists with other settings
+            logger.error("Error: A queue already exists with different settings than queues.toml. "
+                         "Run once with --startup dev, or delete the queue, to recreate it.")
+        logger.error(f"Error: The server closed the channel: {e}")
+        sys.exit(1)
+    except pika.exceptions.AMQPError as e:
+        logger.error(f"Error: Publishing failed: {e!r}")
+        sys.exit(1)
     finally:
-        # close the connection to the server
-        conn.close()
+        # remember how far we got for the next start
+        if cursor is not None:
+            cursor.save()
+        # close the connection to the server (if we got one)
+        if conn is not None:
+            conn.close()
 
-# Standard Python idiom to indicate main program entry point
-# This allows us to import this module and use its functions
-# without executing the code below.
-# If this is the program being run, then execute the code below
-if __name__ == "__main__":  
+def parse_args(argv=None, startup: str = "dev"):
+    parser = argparse.ArgumentParser(description="Replay online transactions to RabbitMQ.")
+    parser.add_argument("--host", default=os.environ.get("RABBITMQ_HOST", "localhost"),
+                        help="the RabbitMQ server (default: $RABBITMQ_HOST or localhost)")
+    parser.add_argument("--profile", choices=["constant", "poisson", "diurnal", "burst", "replay"],
+                        default="constant", help="arrival pattern for the messages")
+    parser.add_argument("--rate", type=float, default=1 / 15, help="average messages per second")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for the arrival times")
+    parser.add_argument("--amplitude", type=float, default=0.8, help="diurnal: swing around the average rate (0-1)")
+    parser.add_argument("--period", type=float, default=86400.0, help="diurnal: seconds in one simulated day")
+    parser.add_argument("--peak-multiplier", type=float, default=10.0, help="burst: rate multiplier during a burst")
+    parser.add_argument("--burst-every", type=float, default=60.0, help="burst: seconds between bursts")
+    parser.add_argument("--burst-length", type=float, default=5.0, help="burst: seconds each burst lasts")
+    parser.add_argument("--compression", type=float, default=3600.0,
+                        help="replay: how many times faster than the recorded timestamps")
+    parser.add_argument("--report-every", type=float, default=10.0, help="seconds between rate reports")
+    parser.add_argument("--monitor", choices=["passive", "api", "off"], default="passive",
+                        help="how to watch queue depth for backpressure")
+    parser.add_argument("--management-url", default=os.environ.get("RABBITMQ_MANAGEMENT_URL"),
+                        help="--monitor api: the management site "
+                             "(default: $RABBITMQ_MANAGEMENT_URL or http://<host>:15672)")
+    parser.add_argument("--management-user", default=os.environ.get("RABBITMQ_MANAGEMENT_USER", "guest"),
+                        help="--monitor api: user name (default: $RABBITMQ_MANAGEMENT_USER or guest)")
+    parser.add_argument("--management-password", default=os.environ.get("RABBITMQ_MANAGEMENT_PASSWORD", "guest"),
+                        help="--monitor api: password (default: $RABBITMQ_MANAGEMENT_PASSWORD or guest)")
+    parser.add_argument("--max-queue-depth", type=int, default=10000, help="pause a queue at this depth")
+    parser.add_argument("--resume-queue-depth", type=int, default=None,
+                        help="resume a paused queue at this depth (default: half the max)")
+    parser.add_argument("--max-pending", type=int, default=1000,
+                        help="messages to hold for a paused queue before blocking")
+    parser.add_argument("--input-file", default="data_online_transactions.csv")
+    parser.add_argument("--startup", choices=["dev", "production"], default=startup,
+                        help="dev clears the queues first; production keeps them and resumes from the cursor")
+    parser.add_argument("--cursor-file", default="producer.cursor",
+                        help="production: file that remembers how far the replay got")
+    # off by default: nothing drains the store queue unless consumer_04_store.py
+    # runs, and backpressure would then hold up the other queues too
+    parser.add_argument("--store-queue", default="",
+                        help="queue for whole transactions, e.g. 04-store (consumer_04_store.py); "
+                             "off by default")
+    parser.add_argument("--restart", action="store_true", help="production: ignore the cursor and start from the top")
+    parser.add_argument("--no-banner", dest="banner", action="store_false",
+                        help="do not log the date, platform and Python details at startup")
+    args = parser.parse_args(argv)
+    # a rate, compression or period of 0 would only fail once the first row is paced
+    for option, value in [("--rate", args.rate), ("--compression", args.compression),
+                          ("--period", args.period), ("--burst-every", args.burst_every)]:
+        if value <= 0:
+            parser.error(f"{option} must be above 0")
+    return args
+
+
+def main(argv=None, interactive: bool = True):
+    """
+    Command line entry point.
+
+    Parameters:
+        argv (list): the command line arguments (default: sys.argv)
+        interactive (bool): offer to open the RabbitMQ Admin site and default
+            to --startup dev; the sales-producer console script turns this off
+            so it never waits for input and defaults to --startup production
+    """
+    args = parse_args(argv, startup="dev" if interactive else "production")
+    setup_logger(__file__, banner=args.banner)
+    profile = make_profile(
+        args.profile,
+        rate=args.rate,
+        seed=args.seed,
+        amplitude=args.amplitude,
+        period=args.period,
+        peak_multiplier=args.peak_multiplier,
+        burst_every=args.burst_every,
+        burst_length=args.burst_length,
+        compression=args.compression,
+    )
+    if args.restart and args.startup == "production" and args.cursor_file:
+        ReplayCursor(args.cursor_file, args.input_file).reset()
     # See if offer_rabbitmq_admin_site() should be called
-    if SHOW_OFFER == True:
+    # (never when nobody is at the terminal to answer)
+    if interactive and SHOW_OFFER == True and sys.stdin.isatty():
         # ask the user if they'd like to open the RabbitMQ Admin site
         offer_rabbitmq_admin_site()
     # send the message to the queue
-    send_message("localhost","01-method","02-amount","03-category","data_online_transactions.csv")  
+    send_message(args.host,"01-method","02-amount","03-category",args.input_file,
+                 store_queue_name=args.store_queue or None,
+                 profile=profile, report_every=args.report_every, monitor=args.monitor,
+                 max_queue_depth=args.max_queue_depth, resume_queue_depth=args.resume_queue_depth,
+                 max_pending=args.max_pending, startup=args.startup, cursor_file=args.cursor_file,
+                 management_url=args.management_url, management_user=args.management_user,
+                 management_password=args.management_password)
+
+
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+    main()
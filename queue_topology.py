@@ -0,0 +1,169 @@
+"""
+    Queue declarations shared by the producer and the consumers.
+
+    RabbitMQ refuses to redeclare a queue with different arguments, so
+    everybody declares the queues the same way, from the settings in
+    queues.toml (or the defaults below if there is no such file):
+
+    - queue_type: "classic", "lazy" (classic, kept on disk rather than in
+      memory, for large backlogs) or "quorum" (replicated)
+    - max_length: the most messages a queue may hold, 0 for no limit
+    - overflow: what happens at max_length: "reject-publish" (the
+      producer's publish is refused), "drop-head" (oldest messages are
+      dropped, or dead-lettered) or "reject-publish-dlx" (classic only)
+    - dead_letter_exchange: where rejected and expired messages go. Each
+      queue gets a "<queue>.dlq" queue bound to it with the queue's name
+      as routing key. Use "" to turn dead-lettering off.
+    - retry_delay: seconds a failed message waits in "<queue>.retry"
+      before it goes back onto the queue, 0 for no retries
+    - max_retries: retries before a failing message is dead-lettered
+      (used by the consumers, see message_handling)
+    - dedup: how the consumers remember message ids to drop redeliveries
+      (see dedup.Deduplicator for window, capacity, error_rate, recent)
+
+    Declaring is idempotent: doing it again with the same settings leaves
+    the queue and its messages alone.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import tomllib  # requires Python 3.11
+
+# Settings used when there is no queues.toml
+DEFAULT_TOPOLOGY = {
+    "queue_type": "classic",
+    "max_length": 0,
+    "overflow": "reject-publish",
+    "dead_letter_exchange": "transactions.dlx",
+    "retry_delay": 5.0,
+    "max_retries": 3,
+    "dedup": {
+        "window": 3600.0,
+        "capacity": 1_000_000,
+        "error_rate": 1e-6,
+        "recent": 10000,
+    },
+}
+
+QUEUE_TYPES = ("classic", "lazy", "quorum")
+OVERFLOW_POLICIES = ("reject-publish", "drop-head", "reject-publish-dlx")
+
+
+def load_topology(path: str = "queues.toml") -> dict:
+    """Read queue settings from a TOML file, falling back to DEFAULT_TOPOLOGY."""
+    topology = dict(DEFAULT_TOPOLOGY)
+    try:
+        with open(path, "rb") as file_object:
+            settings = tomllib.load(file_object)
+    except FileNotFoundError:
+        settings = {}
+    # tables are merged so a file can override a single dedup setting
+    topology["dedup"] = {**DEFAULT_TOPOLOGY["dedup"], **settings.pop("dedup", {})}
+    topology.update(settings)
+    return topology
+
+
+def dead_letter_queue_name(queue: str) -> str:
+    """Name of the queue that collects the dead letters of queue."""
+    return f"{queue}.dlq"
+
+
+def retry_queue_name(queue: str) -> str:
+    """Name of the queue that holds failed messages of queue until they are retried."""
+    return f"{queue}.retry"
+
+
+def queue_arguments(queue_type: str = "classic", max_length: int = 0, overflow: str = "reject-publish",
+                    dead_letter_exchange: str = "", dead_letter_routing_key: str = None) -> dict:
+    """
+    Build the x-arguments for a queue declaration.
+
+    Parameters:
+        queue_type (str): "classic", "lazy" or "quorum"
+        max_length (int): the most messages the queue may hold, 0 for no limit
+        overflow (str): what to do at max_length
+        dead_letter_exchange (str): exchange for rejected messages, "" for none
+        dead_letter_routing_key (str): routing key for dead letters
+    """
+    if queue_type not in QUEUE_TYPES:
+        raise ValueError(f"queue_type must be one of {QUEUE_TYPES}, got {queue_type!r}")
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}, got {overflow!r}")
+    if queue_type == "quorum" and overflow == "reject-publish-dlx":
+        raise ValueError("quorum queues do not support the reject-publish-dlx overflow policy")
+
+    arguments = {}
+    if queue_type == "quorum":
+        arguments["x-queue-type"] = "quorum"
+    elif queue_type == "lazy":
+        arguments["x-queue-mode"] = "lazy"
+    if max_length:
+        arguments["x-max-length"] = max_length
+        arguments["x-overflow"] = overflow
+    if dead_letter_exchange:
+        arguments["x-dead-letter-exchange"] = dead_letter_exchange
+        if dead_letter_routing_key:
+            arguments["x-dead-letter-routing-key"] = dead_letter_routing_key
+    return arguments
+
+
+def declare_queue(ch, queue: str, queue_type: str = "classic", max_length: int = 0,
+                  overflow: str = "reject-publish", dead_letter_exchange: str = "",
+                  retry_delay: float = 0.0, **consumer_settings):
+    """
+    Declare a durable queue, and its dead-letter and retry queues, idempotently.
+
+    Parameters:
+        ch: the channel to declare on
+        queue (str): name of the queue
+        retry_delay (float): seconds messages wait in the retry queue, 0 for none
+        consumer_settings: max_retries and dedup; not used here, accepted
+            so a whole topology can be passed in
+        the rest: see queue_arguments
+    """
+    if dead_letter_exchange:
+        ch.exchange_declare(exchange=dead_letter_exchange, exchange_type="direct", durable=True)
+        # the dead-letter queue has no length limit and no dead-lettering
+        # of its own, so nothing that lands there is lost
+        dead_letters = dead_letter_queue_name(queue)
+        dlq_type = "quorum" if queue_type == "quorum" else "lazy"
+        ch.queue_declare(queue=dead_letters, durable=True, arguments=queue_arguments(dlq_type))
+        ch.queue_bind(queue=dead_letters, exchange=dead_letter_exchange, routing_key=queue)
+
+    if retry_delay > 0:
+        # expired messages are dead-lettered through the default exchange
+        # back onto the original queue
+        arguments = queue_arguments("quorum" if queue_type == "quorum" else "classic")
+        arguments.update({
+            "x-message-ttl": int(retry_delay * 1000),
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": queue,
+        })
+        ch.queue_declare(queue=retry_queue_name(queue), durable=True, arguments=arguments)
+
+    ch.queue_declare(
+        queue=queue,
+        durable=True,
+        arguments=queue_arguments(queue_type, max_length, overflow, dead_letter_exchange, queue),
+    )
+
+
+def declare_queues(ch, queues, topology: dict = None):
+    """Declare every queue in queues with the same settings (default: load_topology())."""
+    topology = load_topology() if topology is None else topology
+    for queue in queues:
+        declare_queue(ch, queue, **topology)
+
+
+def delete_queues(ch, queues):
+    """
+    Delete every queue in queues with its "<queue>.retry" and "<queue>.dlq".
+
+    Their messages are lost. Use this before declaring the queues with
+    changed settings: the retry and dead-letter queues take their type and
+    TTL from the same settings, so they must be recreated too.
+    """
+    for queue in queues:
+        for name in (queue, retry_queue_name(queue), dead_letter_queue_name(queue)):
+            ch.queue_delete(queue=name)
@@ -0,0 +1,117 @@
+"""
+    Remember how far the producer got through the input file.
+
+    Without this, every producer restart re-sends the file from the top.
+    The cursor file records how many rows have been published (and
+    confirmed by the broker) for one input file. On the next start the
+    producer skips those rows and carries on where it left off.
+
+    A cursor is only used for the file it was saved for: same path, at
+    least as large (rows may have been appended), and the same content
+    fingerprint. The fingerprint hashes the first megabyte, header and
+    first rows included, so it is quick for files of any size and a
+    regenerated data file does not resume part way through.
+
+    The cursor also keeps a run id, which the producer puts in every
+    message id. It stays the same while the producer resumes, so rows sent
+    twice after a crash get the same ids and the consumers drop the second
+    copy. A new one is drawn when the cursor starts over (--restart, or a
+    different file), so a deliberate replay is not mistaken for duplicates.
+
+    The cursor is written every save_every rows and when the producer
+    stops. It goes to a temporary file first and is then renamed over the
+    old one, so a crash never leaves a half-written cursor. After a crash,
+    up to save_every rows may be sent a second time.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import hashlib
+import json
+import os
+import secrets
+
+# Bytes at the start of the input file that make up its fingerprint
+FINGERPRINT_BYTES = 1 << 20
+
+
+def file_fingerprint(path: str, length: int = FINGERPRINT_BYTES) -> tuple:
+    """
+    A short hash of the first length bytes of a file, to tell one data file from another.
+
+    Returns (hash, bytes hashed); hash the same number of bytes again to
+    compare, so rows appended to a small file do not change its fingerprint.
+    """
+    with open(path, "rb") as file_object:
+        head = file_object.read(length)
+    return hashlib.blake2b(head, digest_size=8).hexdigest(), len(head)
+
+
+class ReplayCursor:
+    """
+    Position of the producer in its input file.
+
+    Parameters:
+        path (str): the cursor file
+        input_file (str): the file being replayed; a cursor saved for a
+            different file, or for a file that has since shrunk or been
+            regenerated, is ignored
+        save_every (int): rows between saves
+    """
+
+    def __init__(self, path: str, input_file: str, save_every: int = 1000):
+        self.path = path
+        self.input_file = os.path.abspath(input_file)
+        self.save_every = save_every
+        self.position = 0
+        self.saved_position = 0
+        self.fingerprint = file_fingerprint(self.input_file)
+        self.run_id = secrets.token_hex(4)
+
+    def load(self) -> int:
+        """Read the saved position, or 0 if there is no usable cursor."""
+        try:
+            with open(self.path, "r") as file_object:
+                saved = json.load(file_object)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved = {}
+        usable = (
+            saved.get("input_file") == self.input_file
+            and saved.get("input_size", 0) <= os.path.getsize(self.input_file)
+            and "fingerprint" in saved
+            and file_fingerprint(self.input_file, saved["fingerprint_bytes"])[0] == saved["fingerprint"]
+        )
+        self.position = self.saved_position = saved.get("rows_sent", 0) if usable else 0
+        if usable and "run_id" in saved:
+            self.run_id = saved["run_id"]
+        return self.position
+
+    def advance_to(self, position: int):
+        """Record that the first position rows are sent, saving every save_every rows."""
+        self.position = position
+        if self.position - self.saved_position >= self.save_every:
+            self.save()
+
+    def save(self):
+        """Write the cursor file atomically."""
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as file_object:
+            json.dump({
+                "input_file": self.input_file,
+                "input_size": os.path.getsize(self.input_file),
+                "fingerprint": self.fingerprint[0],
+                "fingerprint_bytes": self.fingerprint[1],
+                "rows_sent": self.position,
+                "run_id": self.run_id,
+            }, file_object)
+            file_object.flush()
+            os.fsync(file_object.fileno())
+        os.replace(temporary, self.path)
+        self.saved_position = self.position
+
+    def reset(self):
+        """Start again from the first row, as a new run."""
+        self.position = 0
+        self.run_id = secrets.token_hex(4)
+        self.save()
@@ -0,0 +1,76 @@
+"""
+    Console scripts for the producer and consumers (see pyproject.toml).
+
+    After `pip install .` these start the programs from any directory,
+    without a prompt, so they can run unattended (e.g. one consumer per
+    container, started and stopped as the load changes):
+
+        sales-producer                  message_producer.py, --startup production
+        sales-consumer-method           consumer_01_method.py
+        sales-consumer-amount           consumer_02_amount.py
+        sales-consumer-category         consumer_03_category.py
+        sales-consumer-store            consumer_04_store.py
+        sales-dlq-replay                dlq_replay.py
+        sales-query                     transaction_store.py
+
+    The consumers take --host, --queue and --no-banner; the other commands
+    take the same options as their programs (see --help). The producer and
+    consumers also read the host from the RABBITMQ_HOST environment variable.
+
+    Each program module is imported only when its command runs, and the
+    modules themselves put off importing pika until they connect, so a
+    command starts in about the time it takes to import pika. See
+    benchmarks/bench_startup.py.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import argparse
+import importlib
+import os
+
+
+def run_consumer(module_name: str, queue: str, argv=None):
+    """Parse the common consumer options and run the consumer's main()."""
+    parser = argparse.ArgumentParser(description=f"Run {module_name}.py.")
+    parser.add_argument("--host", default=os.environ.get("RABBITMQ_HOST", "localhost"),
+                        help="the RabbitMQ server (default: $RABBITMQ_HOST or localhost)")
+    parser.add_argument("--queue", default=queue, help=f"the queue to consume (default: {queue})")
+    parser.add_argument("--no-banner", dest="banner", action="store_false",
+                        help="do not log the date, platform and Python details at startup")
+    args = parser.parse_args(argv)
+    module = importlib.import_module(module_name)
+    module.main(args.host, args.queue, banner=args.banner)
+
+
+def consumer_method():
+    run_consumer("consumer_01_method", "01-method")
+
+
+def consumer_amount():
+    run_consumer("consumer_02_amount", "02-amount")
+
+
+def consumer_category():
+    run_consumer("consumer_03_category", "03-category")
+
+
+def consumer_store():
+    run_consumer("consumer_04_store", "04-store")
+
+
+def producer():
+    """The producer without the admin site prompt, defaulting to --startup production."""
+    from message_producer import main
+    main(interactive=False)
+
+
+def dlq_replay():
+    from dlq_replay import main
+    main()
+
+
+def query():
+    from transaction_store import main
+    main()
@@ -0,0 +1,209 @@
+"""
+    Traffic shapes for replaying the transactions file under load.
+
+    The producer used to send one row every 15 seconds. Real traffic is
+    not flat: it follows the time of day and comes in bursts. This module
+    decides *when* each row should be sent and paces the producer to
+    that schedule, so we can push the consumers until they fall behind.
+
+    A profile takes the rows and yields (row, gap) pairs, where gap is the
+    number of seconds to wait after sending the row before the next one:
+
+    - constant_profile: a flat rate (the original behaviour)
+    - poisson_profile: random arrivals at an average rate
+    - diurnal_profile: Poisson arrivals whose rate follows a daily curve
+    - burst_profile: Poisson arrivals with regular bursts at a peak multiplier
+    - replay_profile: the real gaps between Timestamp values, compressed
+
+    The Pacer sends rows on that schedule and logs the actual rate next to
+    the target rate, along with how far behind schedule the producer is.
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import math
+import random
+import time
+from datetime import datetime
+
+
+def constant_profile(rate: float):
+    """Send rate messages per second, evenly spaced."""
+    if rate <= 0:
+        raise ValueError("rate must be above 0")
+
+    def gaps(rows):
+        for row in rows:
+            yield row, 1.0 / rate
+    return gaps
+
+
+def poisson_profile(rate: float, seed: int = None):
+    """Send rate messages per second on average, with exponential gaps."""
+    if rate <= 0:
+        raise ValueError("rate must be above 0")
+    rng = random.Random(seed)
+
+    def gaps(rows):
+        for row in rows:
+            yield row, rng.expovariate(rate)
+    return gaps
+
+
+def varying_rate_profile(rate_at, peak_rate: float, seed: int = None):
+    """
+    Poisson arrivals whose rate changes over time.
+
+    Uses thinning: candidate arrivals are drawn at peak_rate and each one
+    is kept with probability rate_at(t) / peak_rate, where t is the
+    scheduled time in seconds since the first message.
+
+    Parameters:
+        rate_at: function of t returning the target rate at that time
+        peak_rate (float): the highest value rate_at can return
+        seed (int): random seed for reproducible schedules
+    """
+    if peak_rate <= 0:
+        raise ValueError("rate must be above 0")
+    rng = random.Random(seed)
+
+    def gaps(rows):
+        t = 0.0
+        for row in rows:
+            start = t
+            while True:
+                t += rng.expovariate(peak_rate)
+                if rng.random() * peak_rate <= rate_at(t):
+                    break
+            yield row, t - start
+    return gaps
+
+
+def diurnal_profile(rate: float, amplitude: float = 0.8, period: float = 86400.0,
+                    peak_at: float = 0.0, seed: int = None):
+    """
+    Poisson arrivals following a daily curve.
+
+    The rate is rate * (1 + amplitude * cos(...)): it peaks at peak_at
+    seconds into each period and bottoms out half a period later. Shrink
+    period (e.g. to 600) to play a whole day in ten minutes.
+    """
+    if not 0 <= amplitude <= 1:
+        raise ValueError("amplitude must be between 0 and 1")
+    if period <= 0:
+        raise ValueError("period must be above 0")
+
+    def rate_at(t):
+        return rate * (1 + amplitude * math.cos(2 * math.pi * (t - peak_at) / period))
+    return varying_rate_profile(rate_at, rate * (1 + amplitude), seed)
+
+
+def burst_profile(rate: float, peak_multiplier: float = 10.0, burst_every: float = 60.0,
+                  burst_length: float = 5.0, seed: int = None):
+    """
+    Poisson arrivals at rate, with a burst of rate * peak_multiplier
+    lasting burst_length seconds at the start of every burst_every seconds.
+    """
+    if peak_multiplier < 1:
+        raise ValueError("peak_multiplier must be at least 1")
+    if burst_every <= 0:
+        raise ValueError("burst_every must be above 0")
+
+    def rate_at(t):
+        return rate * peak_multiplier if t % burst_every < burst_length else rate
+    return varying_rate_profile(rate_at, rate * peak_multiplier, seed)
+
+
+def replay_profile(compression: float = 1.0, timestamp_index: int = 3):
+    """
+    Replay the real gaps between the rows' timestamps, divided by compression.
+
+    With compression=3600 an hour of recorded transactions plays in one
+    second. Rows must be sorted by timestamp.
+    """
+    if compression <= 0:
+        raise ValueError("compression must be above 0")
+
+    def gaps(rows):
+        previous_row = previous_time = None
+        for row in rows:
+            row_time = datetime.fromisoformat(row[timestamp_index])
+            if previous_row is not None:
+                gap = (row_time - previous_time).total_seconds() / compression
+                yield previous_row, max(gap, 0.0)
+            previous_row, previous_time = row, row_time
+        if previous_row is not None:
+            yield previous_row, 0.0
+    return gaps
+
+
+def make_profile(name: str, rate: float = 1.0, seed: int = None, **options):
+    """Look up a profile by name, passing along only the options it uses."""
+    if name == "constant":
+        return constant_profile(rate)
+    if name == "poisson":
+        return poisson_profile(rate, seed)
+    if name == "diurnal":
+        keys = ("amplitude", "period", "peak_at")
+        return diurnal_profile(rate, seed=seed, **{k: options[k] for k in keys if k in options})
+    if name == "burst":
+        keys = ("peak_multiplier", "burst_every", "burst_length")
+        return burst_profile(rate, seed=seed, **{k: options[k] for k in keys if k in options})
+    if name == "replay":
+        keys = ("compression", "timestamp_index")
+        return replay_profile(**{k: options[k] for k in keys if k in options})
+    raise ValueError(f"Unknown traffic profile: {name}")
+
+
+class Pacer:
+    """
+    Release rows on the schedule a profile sets, and report how well we keep up.
+
+    The schedule is absolute (time of the first message plus the sum of
+    the gaps), so time spent publishing does not add up as drift. When the
+    producer falls behind it sends as fast as it can to catch up; lag is
+    how many seconds the last message went out after its scheduled time.
+    """
+
+    def __init__(self, logger, report_every: float = 10.0, clock=time.monotonic, sleep=time.sleep):
+        self.logger = logger
+        self.report_every = report_every
+        self.clock = clock
+        self.sleep = sleep
+        self.sent = 0
+        self.lag = 0.0
+        self.actual_rate = 0.0
+        self.target_rate = 0.0
+
+    def run(self, shaped_rows):
+        """Yield each row from a profile once its scheduled time has come."""
+        start = self.clock()
+        due = 0.0
+        window_start, window_due, window_sent = start, 0.0, 0
+        for row, gap in shaped_rows:
+            wait = start + due - self.clock()
+            if wait > 0:
+                self.sleep(wait)
+            now = self.clock()
+            self.lag = max(0.0, now - start - due)
+            yield row
+            self.sent += 1
+            window_sent += 1
+            due += gap
+
+            now = self.clock()
+            if now - window_start >= self.report_every:
+                self.report(window_sent, now - window_start, due - window_due)
+                window_start, window_due, window_sent = now, due, 0
+        if window_sent:
+            self.report(window_sent, self.clock() - window_start, due - window_due)
+
+    def report(self, sent: int, elapsed: float, scheduled: float):
+        """Log the rate achieved over the last window next to the rate the schedule asked for."""
+        self.actual_rate = sent / elapsed if elapsed > 0 else 0.0
+        self.target_rate = sent / scheduled if scheduled > 0 else float("inf")
+        self.logger.info(
+            f" [rate] actual {self.actual_rate:.2f} msg/s, target {self.target_rate:.2f} msg/s, "
+            f"lag {self.lag:.2f}s, total sent {self.sent}"
+        )
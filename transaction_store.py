@@ -0,0 +1,278 @@
+"""
+    A local SQLite store of processed transactions that answers questions
+    like "all Store Card purchases over $400 last Tuesday" in milliseconds
+    instead of re-reading the csv file or the logs.
+
+    - Inserts are buffered and written in batches, one transaction per
+      batch, with the database in WAL mode so readers never block the writer.
+    - transactions is indexed on timestamp, and on payment method and
+      category together with timestamp, so filtered time ranges are index
+      range scans.
+    - hourly_rollups keeps the count and total of every hour, payment
+      method and category, updated in the same transaction as the rows.
+      Dashboards read the rollups instead of scanning the transactions.
+
+    Amounts are stored in whole cents and timestamps in seconds since the
+    epoch (the csv timestamps have no time zone and are kept as they are).
+
+    Usage:
+        python transaction_store.py --method "Store Card" --min-amount 400 --start 2023-09-26 --end 2023-09-27
+        python transaction_store.py --summary category --start 2023-09-01
+
+    Author: Jordan Wheeler
+    Date: 2023-10-04
+"""
+
+import argparse
+import calendar
+import sqlite3
+import time
+from datetime import datetime
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    payment_method TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    category TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_ts ON transactions (ts);
+CREATE INDEX IF NOT EXISTS transactions_method_ts ON transactions (payment_method, ts);
+CREATE INDEX IF NOT EXISTS transactions_category_ts ON transactions (category, ts);
+
+CREATE TABLE IF NOT EXISTS hourly_rollups (
+    hour INTEGER NOT NULL,
+    payment_method TEXT NOT NULL,
+    category TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    PRIMARY KEY (hour, payment_method, category)
+) WITHOUT ROWID;
+"""
+
+UPSERT_ROLLUP = """
+INSERT INTO hourly_rollups (hour, payment_method, category, count, amount_cents)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (hour, payment_method, category) DO UPDATE SET
+    count = count + excluded.count,
+    amount_cents = amount_cents + excluded.amount_cents
+"""
+
+# Columns summary() can group by
+SUMMARY_COLUMNS = ("hour", "payment_method", "category")
+
+
+def to_epoch(value) -> int:
+    """Seconds since the epoch for a datetime, an ISO date string or a number."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return calendar.timegm(value.timetuple())
+
+
+def from_epoch(seconds: int) -> str:
+    """Format seconds since the epoch like the csv timestamps."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+
+class TransactionStore:
+    """
+    Batched writer and query API over the SQLite store.
+
+    Parameters:
+        path (str): the database file
+        batch_size (int): rows buffered before they are written
+        flush_interval (float): the most seconds a row waits in the buffer
+            (checked when rows are added; call flush() to force a write)
+    """
+
+    def __init__(self, path: str = "transactions.db", batch_size: int = 500, flush_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffered_since = None
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints; a power cut can lose
+        # the last batches but never corrupts the database
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def add(self, timestamp, payment_method: str, amount, category: str, flush: bool = True) -> bool:
+        """
+        Buffer one transaction. Returns True if this caused the buffer to be written.
+
+        Raises ValueError, and buffers nothing, for a transaction that cannot
+        be stored. If writing the buffer fails the error is raised and the
+        rows, this one included, stay buffered.
+
+        Parameters:
+            timestamp: datetime, "YYYY-MM-DD HH:MM:SS" string or epoch seconds
+            payment_method (str): e.g. "Store Card"
+            amount: the payment amount in dollars
+            category (str): e.g. "Electronics"
+            flush (bool): write the buffer if it is full or old enough; turn
+                off to decide when to write with full(), due() and flush()
+        """
+        self.buffer.append((to_epoch(timestamp), payment_method, round(float(amount) * 100), category))
+        if self.buffered_since is None:
+            self.buffered_since = time.monotonic()
+        if flush and (self.full() or self.due()):
+            self.flush()
+            return True
+        return False
+
+    def full(self) -> bool:
+        """True if batch_size rows are buffered."""
+        return len(self.buffer) >= self.batch_size
+
+    def due(self) -> bool:
+        """True if the oldest buffered row has waited flush_interval seconds."""
+        return self.buffered_since is not None and time.monotonic() - self.buffered_since >= self.flush_interval
+
+    def flush(self) -> int:
+        """
+        Write the buffered rows and their rollups in one transaction. Returns the row count.
+
+        The rows leave the buffer only once the transaction is committed. If
+        the write fails (e.g. "database is locked") it is rolled back, the
+        error is raised, and the next flush() writes the same rows again.
+        """
+        rows = self.buffer
+        if not rows:
+            return 0
+
+        # Pre-aggregate the batch so each hour/method/category is upserted once
+        rollups = {}
+        for ts, payment_method, cents, category in rows:
+            key = (ts - ts % 3600, payment_method, category)
+            count, total = rollups.get(key, (0, 0))
+            rollups[key] = (count + 1, total + cents)
+
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO transactions (ts, payment_method, amount_cents, category) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.executemany(UPSERT_ROLLUP, [key + value for key, value in rollups.items()])
+        self.buffer, self.buffered_since = [], None
+        return len(rows)
+
+    def query(self, start=None, end=None, payment_method: str = None, category: str = None,
+              min_amount: float = None, max_amount: float = None, limit: int = 1000) -> list:
+        """
+        Transactions matching every filter given, oldest first.
+
+        start is inclusive and end exclusive. Returns a list of dicts with
+        timestamp, payment_method, amount and category.
+        """
+        where, params = self._filters(start, end, payment_method, category, "ts")
+        if min_amount is not None:
+            where.append("amount_cents >= ?")
+            params.append(round(min_amount * 100))
+        if max_amount is not None:
+            where.append("amount_cents <= ?")
+            params.append(round(max_amount * 100))
+        sql = "SELECT ts, payment_method, amount_cents, category FROM transactions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts LIMIT ?"
+        params.append(limit)
+        return [
+            {"timestamp": from_epoch(ts), "payment_method": method, "amount": cents / 100, "category": cat}
+            for ts, method, cents, cat in self.conn.execute(sql, params)
+        ]
+
+    def summary(self, by: str = "hour", start=None, end=None, payment_method: str = None,
+                category: str = None) -> list:
+        """
+        Count and total of the transactions from the hourly rollups.
+
+        Parameters:
+            by (str): "hour", "payment_method" or "category"
+            start, end: time range, rounded to whole hours (start inclusive)
+            payment_method, category (str): optional filters
+        Returns a list of dicts with the group value, count and total.
+        """
+        if by not in SUMMARY_COLUMNS:
+            raise ValueError(f"by must be one of {SUMMARY_COLUMNS}, got {by!r}")
+        start = to_epoch(start)
+        if start is not None:
+            start -= start % 3600
+        where, params = self._filters(start, end, payment_method, category, "hour")
+        sql = f"SELECT {by}, SUM(count), SUM(amount_cents) FROM hourly_rollups"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" GROUP BY {by} ORDER BY {by}"
+        return [
+            {by: from_epoch(group) if by == "hour" else group, "count": count, "total": cents / 100}
+            for group, count, cents in self.conn.execute(sql, params)
+        ]
+
+    @staticmethod
+    def _filters(start, end, payment_method, category, time_column):
+        where, params = [], []
+        if start is not None:
+            where.append(f"{time_column} >= ?")
+            params.append(to_epoch(start))
+        if end is not None:
+            where.append(f"{time_column} < ?")
+            params.append(to_epoch(end))
+        if payment_method is not None:
+            where.append("payment_method = ?")
+            params.append(payment_method)
+        if category is not None:
+            where.append("category = ?")
+            params.append(category)
+        return where, params
+
+    def close(self):
+        """Write what is buffered and close the database (even if the write fails)."""
+        try:
+            self.flush()
+        finally:
+            self.conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Query the local store of processed transactions.")
+    parser.add_argument("--db", default="transactions.db", help="the database file")
+    parser.add_argument("--start", help="earliest timestamp, e.g. 2023-09-26 or '2023-09-26 08:00:00'")
+    parser.add_argument("--end", help="timestamp to stop before")
+    parser.add_argument("--method", help="payment method, e.g. 'Store Card'")
+    parser.add_argument("--category", help="category, e.g. Electronics")
+    parser.add_argument("--min-amount", type=float)
+    parser.add_argument("--max-amount", type=float)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--summary", choices=SUMMARY_COLUMNS,
+                        help="show counts and totals from the hourly rollups instead of transactions")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Command line entry point (also the sales-query console script)."""
+    args = parse_args(argv)
+    store = TransactionStore(args.db)
+    started = time.perf_counter()
+    if args.summary:
+        results = store.summary(args.summary, args.start, args.end, args.method, args.category)
+    else:
+        results = store.query(args.start, args.end, args.method, args.category,
+                              args.min_amount, args.max_amount, args.limit)
+    elapsed = (time.perf_counter() - started) * 1000
+    for result in results:
+        print(", ".join(f"{key}={value}" for key, value in result.items()))
+    print(f"{len(results)} results in {elapsed:.1f} ms")
+    store.close()
+
+
+# Standard Python idiom to indicate main program entry point
+# This allows us to import this module and use its functions
+# without executing the code below.
+# If this is the program being run, then execute the code below
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,15 @@ USAGE:
   from util_logger import setup_logger
   logger, logname = setup_logger(__file__)
 
+Programs that should start fast get the logger at import time and set it
+up when they run, optionally without the system banner:
+
+  from util_logger import get_logger, setup_logger
+  logger = get_logger(__file__)
+
+  def main():
+      setup_logger(__file__, banner=False)
+
 In your code file, instead of print(), use logger.info().
 
   logger.info(f"Name: {name} ")
@@ -40,7 +49,6 @@ Levels include: debug, info, warning, error, and critical.
 
 import logging
 import pathlib
-import platform
 import sys
 import os
 import datetime
@@ -52,19 +60,33 @@ DIVIDER = "=" * 50  # A string divider for cleaner output formatting
 # Define program functions (reusable bits of code)
 
 
-def setup_logger(current_file):
+def get_logger(current_file):
+    """
+    Get the logger for a file without setting it up (cheap; no files opened).
+    @param current_file: the name of the file requesting a logger.
+    @returns: the logger object; setup_logger() later adds its handlers.
+    """
+    return logging.getLogger(pathlib.Path(current_file).stem)
+
+
+def setup_logger(current_file, banner=True):
     """
     Setup a logger to automatically record useful information.
     @param current_file: the name of the file requesting a logger.
+    @param banner: log the date, platform and Python details first.
     @returns: the logger object and the name of the logfile.
     """
     logs_dir = pathlib.Path("logs")
-    logs_dir.mkdir(exist_ok=True)
-
     module_name = pathlib.Path(current_file).stem
     log_file_name = logs_dir.joinpath(module_name + ".log")
 
-    logger = logging.getLogger(module_name)
+    logger = get_logger(current_file)
+    # Already set up (setup_logger called again, e.g. main() run twice in one
+    # process): adding handlers again would log every line twice
+    if logger.handlers:
+        return logger, log_file_name
+
+    logs_dir.mkdir(exist_ok=True)
     logger.setLevel(logging.DEBUG)  # Set the root logger level.
 
     # Create file handler to write logging messages to a file
@@ -84,6 +106,12 @@ def setup_logger(current_file):
     logger.addHandler(file_handler)
     logger.addHandler(console_handler)
 
+    if not banner:
+        return logger, log_file_name
+
+    # Imported here so programs that skip the banner skip this too
+    import platform
+
     python_version_string = platform.python_version()
     today = datetime.date.today()
 